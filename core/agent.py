@@ -1,8 +1,12 @@
+import contextlib
+
+import gymnasium as gym
 import numpy as np
 from core import mod_neuro_evo as utils_ne
 from core import utils
-from core import replay_memory
 from core import ddpg as ddpg
+from core.async_learner import ActingAgent, AsyncLearner, SynchronizedReplayBuffer
+from core.rollout_workers import RolloutWorkerPool
 from scipy.spatial import distance
 from parameters import Parameters
 import torch
@@ -22,22 +26,32 @@ class Agent:
         self.args = args
         self.env = env
 
+        self.replay_buffer = utils.make_replay_buffer(args)
+        if args.async_learner:
+            # Shared by the genes, TD3 and the learner thread
+            self.replay_buffer = SynchronizedReplayBuffer(self.replay_buffer)
+
+        # Weights of the population and of the RL actor, one row per actor
+        self.population = ddpg.PopulationTensor(args, args.pop_size + 1)
+        self.actor_params = self.population.params
+
         # Init population
         self.pop = []
         self.buffers = []
-        self.all_actors = []
-        for _ in range(args.pop_size):
+        for i in range(args.pop_size):
             # self.pop.append(ddpg.GeneticAgent(args))
-            genetic = ddpg.GeneticAgent(args)
+            genetic = ddpg.GeneticAgent(args, self.replay_buffer, self.population, i)
             self.pop.append(genetic)
-            self.all_actors.append(genetic.actor)
 
         # Init RL Agent
 
-        self.rl_agent = ddpg.TD3(args)
-        self.replay_buffer = utils.ReplayBuffer()
+        self.rl_agent = ddpg.TD3(
+            args, self.replay_buffer, self.population, args.pop_size
+        )
 
-        self.all_actors.append(self.rl_agent.actor)
+        self.actor_bank = ddpg.ActorBank(
+            self.pop + [self.rl_agent.actor], self.actor_params
+        )
 
         self.ounoise = ddpg.OUNoise(args.action_dim)
         self.evolver = utils_ne.SSNE(
@@ -67,6 +81,33 @@ class Agent:
         self.old_fitness = None
         self.evo_times = 0
 
+        # Environments used to evaluate several agents in lockstep
+        self.lockstep_envs = []
+        # Worker processes used to evaluate several agents in parallel
+        self.rollout_workers = None
+        if args.num_workers > 0:
+            self.rollout_workers = RolloutWorkerPool(args, args.num_workers)
+
+        # Networks used to step the environments, copies of the RL agent's networks
+        # refreshed once per generation when TD3 trains asynchronously
+        self.learner = None
+        self.acting_agent = self.rl_agent
+        if args.async_learner:
+            self.learner = AsyncLearner(
+                args, self.rl_agent, self.replay_buffer, self.actor_bank
+            )
+            self.acting_agent = ActingAgent(args, self.rl_agent)
+
+    @staticmethod
+    def policy(agent):
+        """
+        :return: the member of an ActorBank acting for the agent, the genes themselves
+            so that evaluating them does not create their Actor modules
+        """
+        if isinstance(agent, ddpg.GeneticAgent):
+            return agent
+        return agent.actor
+
     def evaluate(
         self,
         agent: ddpg.GeneticAgent | ddpg.TD3,
@@ -82,12 +123,13 @@ class Agent:
     ):
         total_reward = 0.0
         total_error = 0.0
-        policy_params = (
-            torch.nn.utils.parameters_to_vector(list(agent.actor.parameters()))
-            .data.cpu()
-            .numpy()
-            .reshape([-1])
-        )
+        policy = ddpg.ActorBank([self.policy(agent)])
+        policy_params = policy.flat_parameters()[0].cpu().numpy()
+        policy_id = None
+        if store_transition:
+            # Held by the episode until its transitions are stored
+            policy_id = self.replay_buffer.policy_versions.add(policy_params)
+            self.replay_buffer.policy_versions.acquire(policy_id)
         state = self.env.reset()[0]
         done = False
 
@@ -95,7 +137,6 @@ class Agent:
         reward_list = []
 
         action_list = []
-        policy_params_list = []
         n_step_discount_reward = 0.0
         episode_timesteps = 0
         all_state = []
@@ -113,7 +154,7 @@ class Agent:
             if is_random:
                 action = self.env.action_space.sample()
             else:
-                action = agent.actor.select_action(np.array(state), state_embedding_net)
+                action = policy.select_action([np.array(state)], state_embedding_net)[0]
                 if is_action_noise:
                     action = (
                         action + np.random.normal(0, 0.1, size=self.args.action_dim)
@@ -132,42 +173,31 @@ class Agent:
             )
             state_list.append(state)
             reward_list.append(reward)
-            policy_params_list.append(policy_params)
             action_list.append(action.flatten())
 
-            transition = (state, action, next_state, reward, done_bool)
             if store_transition:
-                next_action = agent.actor.select_action(
-                    np.array(next_state), state_embedding_net
-                )
-                self.replay_buffer.add(
-                    (
-                        state,
-                        next_state,
-                        action,
-                        reward,
-                        done_bool,
-                        next_action,
-                        policy_params,
-                    )
+                next_action = policy.select_action(
+                    [np.array(next_state)], state_embedding_net
+                )[0]
+                self.store_transition(
+                    agent,
+                    state,
+                    action,
+                    next_state,
+                    reward,
+                    done_bool,
+                    next_action,
+                    policy_id,
                 )
-                # self.replay_buffer.add(*transition)
-                agent.buffer.add(*transition)
             episode_timesteps += 1
             state = next_state
 
             if use_n_step_return:
                 if self.args.time_steps <= episode_timesteps:
-                    next_action = agent.actor.select_action(
-                        np.array(next_state), state_embedding_net
-                    )
-                    param = (
-                        nn.utils.parameters_to_vector(list(agent.actor.parameters()))
-                        .data.cpu()
-                        .numpy()
-                    )
-                    param = torch.FloatTensor(param).to(self.args.device)
-                    param = param.repeat(1, 1)
+                    next_action = policy.select_action(
+                        [np.array(next_state)], state_embedding_net
+                    )[0]
+                    param = policy.flat_parameters()
 
                     # print("1")
                     next_state = torch.FloatTensor(np.array([next_state])).to(
@@ -190,6 +220,7 @@ class Agent:
                     break
         if store_transition:
             self.num_games += 1
+            self.replay_buffer.policy_versions.release(policy_id)
 
         return {
             "n_step_discount_reward": n_step_discount_reward,
@@ -197,15 +228,230 @@ class Agent:
             "td_error": total_error,
             "state_list": state_list,
             "reward_list": reward_list,
-            "policy_prams_list": policy_params_list,
+            "policy_id": policy_id,
             "action_list": action_list,
         }
 
-    def rl_to_evo(self, rl_agent: ddpg.TD3, evo_net: ddpg.GeneticAgent):
-        for target_param, param in zip(
-            evo_net.actor.parameters(), rl_agent.actor.parameters()
+    def store_transition(
+        self,
+        agent: ddpg.GeneticAgent | ddpg.TD3,
+        state,
+        action,
+        next_state,
+        reward,
+        done_bool,
+        next_action,
+        policy_id,
+    ):
+        seq = self.replay_buffer.add(
+            (
+                state,
+                next_state,
+                action,
+                reward,
+                done_bool,
+                next_action,
+                policy_id,
+            )
+        )
+        agent.buffer.add(seq)
+
+    def get_lockstep_envs(self, num_envs):
+        while len(self.lockstep_envs) < num_envs:
+            env = gym.make(self.args.env_name)
+            env.reset(seed=self.args.seed + len(self.lockstep_envs) + 1)
+            self.lockstep_envs.append(env)
+        return self.lockstep_envs[:num_envs]
+
+    def evaluate_population(
+        self,
+        agents,
+        state_embedding_net,
+        is_render=False,
+        is_action_noise=False,
+        store_transition=True,
+        use_n_step_return=False,
+        PeVFA=None,
+    ):
+        """
+        Runs one episode for each of the agents in lockstep, every agent in its own
+        environment, with a single batched forward pass per timestep
+        :param agents: the agents to evaluate, the same agent may appear more than once
+        :return: a list with one episode dictionary per agent, as returned by evaluate
+        """
+        envs = self.get_lockstep_envs(len(agents))
+        device = self.args.device
+
+        bank = ddpg.ActorBank([self.policy(agent) for agent in agents]).snapshot()
+        all_params = bank.flat_parameters().cpu().numpy()
+
+        episodes = [
+            {
+                "n_step_discount_reward": 0.0,
+                "reward": 0.0,
+                "td_error": 0.0,
+                "state_list": [],
+                "reward_list": [],
+                "policy_id": None,
+                "action_list": [],
+            }
+            for params in all_params
+        ]
+        if store_transition:
+            # Held by the episodes until their transitions are stored
+            for episode, params in zip(episodes, all_params):
+                episode["policy_id"] = self.replay_buffer.policy_versions.add(params)
+                self.replay_buffer.policy_versions.acquire(episode["policy_id"])
+        active = list(range(len(agents)))
+        states = [env.reset()[0] for env in envs]
+        actions = bank.select_action(states, state_embedding_net, active)
+        episode_timesteps = 0
+
+        while active:
+            next_states = []
+            dones = []
+            for row, i in enumerate(active):
+                if store_transition:
+                    self.num_frames += 1
+                    self.gen_frames += 1
+
+                action = actions[row]
+                if is_action_noise:
+                    action = (
+                        action + np.random.normal(0, 0.1, size=self.args.action_dim)
+                    ).clip(-1.0, 1.0)
+                next_state, reward, terminated, truncated, info = envs[i].step(action)
+                done = terminated or truncated
+                episode = episodes[i]
+                episode["reward"] += reward
+                episode["n_step_discount_reward"] += (
+                    math.pow(self.args.gamma, episode_timesteps) * reward
+                )
+                episode["state_list"].append(states[row])
+                episode["reward_list"].append(reward)
+                episode["action_list"].append(action)
+
+                next_states.append(next_state)
+                dones.append(done)
+
+            # The deterministic next actions are also the actions of the next step
+            next_actions = bank.select_action(next_states, state_embedding_net, active)
+            if store_transition:
+                for row, i in enumerate(active):
+                    done_bool = (
+                        0 if episode_timesteps + 1 == 1000 else float(dones[row])
+                    )
+                    self.store_transition(
+                        agents[i],
+                        states[row],
+                        episodes[i]["action_list"][-1],
+                        next_states[row],
+                        episodes[i]["reward_list"][-1],
+                        done_bool,
+                        next_actions[row],
+                        episodes[i]["policy_id"],
+                    )
+            episode_timesteps += 1
+
+            if use_n_step_return and self.args.time_steps <= episode_timesteps:
+                param = torch.FloatTensor(all_params[active])
+                input = torch.cat(
+                    [
+                        torch.FloatTensor(np.array(next_states)),
+                        torch.FloatTensor(next_actions),
+                    ],
+                    -1,
+                )
+                with torch.no_grad():
+                    next_Q1, next_Q2 = PeVFA.forward(input.to(device), param.to(device))
+                next_state_Q = torch.min(next_Q1, next_Q2).cpu().numpy().flatten()
+                for row, i in enumerate(active):
+                    episodes[i]["n_step_discount_reward"] += (
+                        math.pow(self.args.gamma, episode_timesteps) * next_state_Q[row]
+                    )
+                keep = []
+            else:
+                keep = [row for row, done in enumerate(dones) if not done]
+
+            if store_transition:
+                self.num_games += len(active) - len(keep)
+            active = [active[row] for row in keep]
+            states = [next_states[row] for row in keep]
+            actions = next_actions[keep]
+
+        if store_transition:
+            for episode in episodes:
+                self.replay_buffer.policy_versions.release(episode["policy_id"])
+        return episodes
+
+    def evaluate_remote(
+        self,
+        agents,
+        state_embedding_net,
+        is_render=False,
+        is_action_noise=False,
+        store_transition=True,
+        use_n_step_return=False,
+        PeVFA=None,
+    ):
+        """
+        Runs one episode for each of the agents on the rollout worker processes and
+        stores the returned transitions in the order of agents
+        :return: a list with one episode dictionary per agent, as returned by evaluate
+        """
+        all_params = (
+            ddpg.ActorBank([self.policy(agent) for agent in agents])
+            .snapshot()
+            .flat_parameters()
+            .cpu()
+            .numpy()
+        )
+        episodes = []
+        for i, episode in self.rollout_workers.run(
+            all_params,
+            state_embedding_net,
+            is_action_noise=is_action_noise,
+            store_transition=store_transition,
+            PeVFA=PeVFA if use_n_step_return else None,
         ):
-            target_param.data.copy_(param.data)
+            episode["policy_id"] = None
+            if store_transition:
+                episode["policy_id"] = self.replay_buffer.policy_versions.add(
+                    all_params[i]
+                )
+                self.replay_buffer.policy_versions.acquire(episode["policy_id"])
+                for transition in episode["transitions"]:
+                    self.num_frames += 1
+                    self.gen_frames += 1
+                    self.store_transition(agents[i], *transition, episode["policy_id"])
+                self.replay_buffer.policy_versions.release(episode["policy_id"])
+                self.num_games += 1
+            del episode["transitions"]
+            episodes.append(episode)
+        return episodes
+
+    def evaluate_all(self, agents, state_embedding_net, **kwargs):
+        """
+        Runs one episode per agent, on the rollout workers when -num_workers is set
+        or in lockstep when -vec_eval is set
+        """
+        if self.rollout_workers is not None:
+            return self.evaluate_remote(agents, state_embedding_net, **kwargs)
+        if self.args.vec_eval:
+            return self.evaluate_population(agents, state_embedding_net, **kwargs)
+        return [self.evaluate(agent, state_embedding_net, **kwargs) for agent in agents]
+
+    def paused_learner(self):
+        """Stops the asynchronous learner while the RL networks are read or modified"""
+        if self.learner is None:
+            return contextlib.nullcontext()
+        return self.learner.paused()
+
+    def rl_to_evo(self, rl_agent: ddpg.TD3, evo_net: ddpg.GeneticAgent):
+        rl_actor = rl_agent.actor
+        evo_net.population.set_rows(
+            [evo_net.index], rl_actor.population.get_rows([rl_actor.index])
+        )
         evo_net.buffer.reset()
         evo_net.buffer.add_content_of(rl_agent.buffer)
 
@@ -216,12 +462,14 @@ class Agent:
     def get_pop_novelty(self):
         epochs = self.args.ns_epochs
         novelties = np.zeros(len(self.pop))
+        pop_bank = self.actor_bank.subset(range(len(self.pop)))
         for _ in range(epochs):
-            transitions = self.replay_buffer.sample(self.args.batch_size)
-            batch = replay_memory.Transition(*zip(*transitions))
-
-            for i, net in enumerate(self.pop):
-                novelties[i] += net.get_novelty(batch)
+            state, _, action, _, _, _, _ = self.replay_buffer.sample_batch(
+                self.args.batch_size, self.args.device
+            )
+            novelties += pop_bank.get_novelty(
+                state, action, self.rl_agent.state_embedding
+            )
         return novelties / epochs
 
     def train_ddpg(
@@ -230,17 +478,17 @@ class Agent:
         all_fitness,
         state_list_list,
         reward_list_list,
-        policy_params_list_list,
+        policy_id_list,
         action_list_list,
     ):
-        if len(self.replay_buffer.storage) >= 5000:  # self.args.batch_size * 5:
+        if len(self.replay_buffer) >= 5000:  # self.args.batch_size * 5:
             before_rewards = np.zeros(len(self.pop))
 
             ddpg.hard_update(
                 self.rl_agent.old_state_embedding, self.rl_agent.state_embedding
             )
             for gen in self.pop:
-                ddpg.hard_update(gen.old_actor, gen.actor)
+                gen.save_old_actor()
 
             discount_reward_list_list = []
             for reward_list in reward_list_list:
@@ -252,8 +500,10 @@ class Agent:
                 np.array(discount_reward_list_list)
             )
             # print("discount_reward_list_list ",discount_reward_list_list.shape)
-            policy_params_list_list = np.concatenate(np.array(policy_params_list_list))
-            # print("policy_params_list_list ", policy_params_list_list.shape)
+            policy_ids = np.repeat(
+                policy_id_list, [len(reward_list) for reward_list in reward_list_list]
+            )
+            policy_params_list_list = self.replay_buffer.policy_versions.get(policy_ids)
             action_list_list = np.concatenate(np.array(action_list_list))
             pgl, delta, pre_loss, pv_loss, keep_c_loss = self.rl_agent.train(
                 evo_times,
@@ -270,7 +520,7 @@ class Agent:
                 tau=self.args.tau,
                 policy_noise=self.args.TD3_noise,
                 train_OFN_use_multi_actor=self.args.random_choose,
-                all_actor=self.all_actors,
+                all_actor=self.actor_bank,
             )
             after_rewards = np.zeros(len(self.pop))
         else:
@@ -307,36 +557,34 @@ class Agent:
         state_list_list = []
 
         reward_list_list = []
-        policy_parms_list_list = []
+        policy_id_list = []
         action_list_list = []
 
         if self.args.EA and self.rl_agent_frames >= self.args.init_steps:
             self.evo_times += 1
             random_num_num = random.random()
             if random_num_num < self.args.theta:
-                for i, net in enumerate(self.pop):
-                    for _ in range(self.args.num_evals):
-                        episode = self.evaluate(
-                            net,
-                            self.rl_agent.state_embedding,
-                            is_render=False,
-                            is_action_noise=False,
-                            net_index=i,
-                        )
+                for _ in range(self.args.num_evals):
+                    episodes = self.evaluate_all(
+                        self.pop,
+                        self.acting_agent.state_embedding,
+                        is_render=False,
+                        is_action_noise=False,
+                    )
+                    for i, episode in enumerate(episodes):
                         real_rewards[i] += episode["reward"]
                 real_rewards /= self.args.num_evals
                 all_fitness = real_rewards
             else:
-                for i, net in enumerate(self.pop):
-                    episode = self.evaluate(
-                        net,
-                        self.rl_agent.state_embedding,
-                        is_render=False,
-                        is_action_noise=False,
-                        net_index=i,
-                        use_n_step_return=True,
-                        PeVFA=self.rl_agent.PVN,
-                    )
+                episodes = self.evaluate_all(
+                    self.pop,
+                    self.acting_agent.state_embedding,
+                    is_render=False,
+                    is_action_noise=False,
+                    use_n_step_return=True,
+                    PeVFA=self.acting_agent.PVN,
+                )
+                for i, episode in enumerate(episodes):
                     fake_rewards[i] += episode["n_step_discount_reward"]
                     MC_n_steps_rewards[i] += episode["reward"]
                 all_fitness = fake_rewards
@@ -359,20 +607,21 @@ class Agent:
         test_score = 0
 
         if self.args.EA and self.rl_agent_frames >= self.args.init_steps:
-            for eval in range(10):
-                episode = self.evaluate(
-                    champion,
-                    self.rl_agent.state_embedding,
-                    is_render=True,
-                    is_action_noise=False,
-                    store_transition=False,
-                )
+            episodes = self.evaluate_all(
+                [champion] * 10,
+                self.acting_agent.state_embedding,
+                is_render=True,
+                is_action_noise=False,
+                store_transition=False,
+            )
+            for episode in episodes:
                 test_score += episode["reward"]
         test_score /= 10.0
 
         # NeuroEvolution's probabilistic selection and recombination step
         if self.args.EA:
-            elite_index = self.evolver.epoch(self.pop, all_fitness)
+            with self.paused_learner():
+                elite_index = self.evolver.epoch(self.pop, all_fitness)
         else:
             elite_index = 0
         # ========================== DDPG or TD3 ===========================
@@ -381,8 +630,8 @@ class Agent:
         if self.args.RL:
             is_random = self.rl_agent_frames < self.args.init_steps
             episode = self.evaluate(
-                self.rl_agent,
-                self.rl_agent.state_embedding,
+                self.acting_agent,
+                self.acting_agent.state_embedding,
                 is_action_noise=True,
                 is_random=is_random,
                 rl_agent_collect_data=True,
@@ -390,16 +639,19 @@ class Agent:
 
             state_list_list.append(episode["state_list"])
             reward_list_list.append(episode["reward_list"])
-            policy_parms_list_list.append(episode["policy_prams_list"])
+            policy_id_list.append(episode["policy_id"])
             action_list_list.append(episode["action_list"])
 
-            if self.rl_agent_frames >= self.args.init_steps:
+            if self.learner is not None:
+                losses = self.learner.losses()
+                add_rewards = np.zeros(len(self.pop))
+            elif self.rl_agent_frames >= self.args.init_steps:
                 losses, _, add_rewards = self.train_ddpg(
                     self.evo_times,
                     all_fitness,
                     state_list_list,
                     reward_list_list,
-                    policy_parms_list_list,
+                    policy_id_list,
                     action_list_list,
                 )
             else:
@@ -430,13 +682,13 @@ class Agent:
         testr = 0
 
         if self.args.RL:
-            for eval in range(10):
-                ddpg_stats = self.evaluate(
-                    self.rl_agent,
-                    self.rl_agent.state_embedding,
-                    store_transition=False,
-                    is_action_noise=False,
-                )
+            all_ddpg_stats = self.evaluate_all(
+                [self.acting_agent] * 10,
+                self.acting_agent.state_embedding,
+                store_transition=False,
+                is_action_noise=False,
+            )
+            for ddpg_stats in all_ddpg_stats:
                 testr += ddpg_stats["reward"]
             testr /= 10.0
 
@@ -452,10 +704,25 @@ class Agent:
                 if replace_index == elite_index:
                     replace_index = (replace_index + 1) % len(self.pop)
 
-                self.rl_to_evo(self.rl_agent, self.pop[replace_index])
+                with self.paused_learner():
+                    self.rl_to_evo(self.rl_agent, self.pop[replace_index])
                 self.evolver.rl_policy = replace_index
                 print("Sync from RL --> Nevo")
 
+        # Hand this generation's frames to the asynchronous learner, which trains on
+        # them while the next generation is collected
+        if self.learner is not None:
+            self.learner.wait()
+            with self.paused_learner():
+                self.acting_agent.sync()
+            if (
+                self.args.RL
+                and self.rl_agent_frames >= self.args.init_steps
+                and len(self.replay_buffer) >= 5000
+            ):
+                self.learner.add_frames(self.gen_frames, self.evo_times, all_fitness)
+
+        self.replay_buffer.flush()
         self.old_fitness = all_fitness
         # -------------------------- Collect statistics --------------------------
 
@@ -0,0 +1,213 @@
+import atexit
+import contextlib
+import threading
+
+import numpy as np
+
+from core import ddpg
+from parameters import Parameters
+
+
+class SynchronizedReplayBuffer:
+    """Replay buffer wrapper which makes adding and sampling safe across threads"""
+
+    def __init__(self, replay_buffer):
+        self.replay_buffer = replay_buffer
+        self.lock = threading.Lock()
+
+    def add(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.add(*args, **kwargs)
+
+    def sample(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.sample(*args, **kwargs)
+
+    def sample_batch(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.sample_batch(*args, **kwargs)
+
+    def get_batch_tensors(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.get_batch_tensors(*args, **kwargs)
+
+    def sample_indices(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.sample_indices(*args, **kwargs)
+
+    def importance_weights(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.importance_weights(*args, **kwargs)
+
+    def update_priorities(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.update_priorities(*args, **kwargs)
+
+    def get_transitions(self, *args, **kwargs):
+        with self.lock:
+            return self.replay_buffer.get_transitions(*args, **kwargs)
+
+    def __len__(self):
+        return len(self.replay_buffer)
+
+    def __getattr__(self, name):
+        return getattr(self.replay_buffer, name)
+
+
+class ActingAgent:
+    """
+    Copies of the learner's actor, state embedding and PVN used to step the
+    environments while the learner keeps updating the originals
+    """
+
+    def __init__(self, args: Parameters, rl_agent: ddpg.TD3):
+        self.rl_agent = rl_agent
+        self.actor = ddpg.Actor(args)
+        self.state_embedding = ddpg.shared_state_embedding(args)
+        self.PVN = ddpg.Policy_Value_Network(args)
+        self.buffer = rl_agent.buffer
+        self.sync()
+
+    def sync(self):
+        ddpg.hard_update(self.actor, self.rl_agent.actor)
+        ddpg.hard_update(self.state_embedding, self.rl_agent.state_embedding)
+        ddpg.hard_update(self.PVN, self.rl_agent.PVN)
+
+
+class AsyncLearner:
+    """
+    Runs TD3.train in a background thread, concurrently with environment stepping.
+
+    Every collected frame adds utd_ratio gradient steps to the learner's budget, so
+    the total number of updates matches the synchronous schedule. The learner trains
+    in chunks of chunk_size iterations while holding self.lock, paused() stops it
+    between chunks for code that reads or modifies the networks it trains.
+    """
+
+    def __init__(
+        self,
+        args: Parameters,
+        rl_agent: ddpg.TD3,
+        replay_buffer,
+        all_actor,
+        chunk_size=50,
+    ):
+        self.args = args
+        self.rl_agent = rl_agent
+        self.replay_buffer = replay_buffer
+        self.all_actor = all_actor
+        self.chunk_size = chunk_size
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.target_steps = 0.0
+        self.steps = 0
+        self.pause_requests = 0
+        self.evo_times = 0
+        self.all_fitness = None
+        self.results = []
+        self.error = None
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add_frames(self, frames, evo_times, all_fitness):
+        with self.condition:
+            self.evo_times = evo_times
+            self.all_fitness = all_fitness
+            self.target_steps += frames * self.args.utd_ratio
+            self.condition.notify_all()
+
+    def wait(self):
+        """Blocks until every gradient step granted so far has been taken"""
+        with self.condition:
+            while self.steps < int(self.target_steps) and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+
+    @contextlib.contextmanager
+    def paused(self):
+        with self.condition:
+            self.pause_requests += 1
+        try:
+            with self.lock:
+                yield
+        finally:
+            with self.condition:
+                self.pause_requests -= 1
+                self.condition.notify_all()
+
+    def close(self):
+        """Stops the learner after its current chunk"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def losses(self):
+        """Mean losses of the chunks finished since the last call, as in train_ddpg"""
+        with self.condition:
+            results, self.results = self.results, []
+        if not results:
+            return {
+                "bcs_loss": 0.0,
+                "pgs_loss": 0.0,
+                "current_q": 0.0,
+                "target_q": 0.0,
+                "pv_loss": 0.0,
+                "pre_loss": 0.0,
+            }
+        pgl, delta, pre_loss, pv_loss, _ = np.mean(results, axis=0)
+        return {
+            "pv_loss": pv_loss,
+            "bcs_loss": delta,
+            "pgs_loss": pgl,
+            "current_q": 0.0,
+            "target_q": 0.0,
+            "pre_loss": pre_loss,
+        }
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (
+                    self.pause_requests > 0 or self.steps >= int(self.target_steps)
+                ):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                iterations = min(self.chunk_size, int(self.target_steps) - self.steps)
+                evo_times, all_fitness = self.evo_times, self.all_fitness
+
+            try:
+                with self.lock:
+                    result = self.rl_agent.train(
+                        evo_times,
+                        all_fitness,
+                        None,
+                        None,
+                        None,
+                        None,
+                        None,
+                        self.replay_buffer,
+                        iterations,
+                        self.args.batch_size,
+                        discount=self.args.gamma,
+                        tau=self.args.tau,
+                        policy_noise=self.args.TD3_noise,
+                        train_OFN_use_multi_actor=self.args.random_choose,
+                        all_actor=self.all_actor,
+                    )
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.steps += iterations
+                self.results.append(result)
+                self.condition.notify_all()
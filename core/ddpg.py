@@ -1,4 +1,6 @@
+import math
 import random
+from functools import cached_property
 
 import numpy as np
 import torch
@@ -7,32 +9,128 @@ from torch.nn import functional as F
 from torch.optim import Adam
 
 from core import replay_memory
+from core.prefetch import sample_batches
 from core.mod_utils import is_lnorm_key
 from parameters import Parameters
 
 
+def module_parameters(modules):
+    if isinstance(modules, nn.Module):
+        modules = [modules]
+    return [param for module in modules for param in module.parameters()]
+
+
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    """
+    Polyak averaging of the parameters of target towards source, with one fused
+    multi-tensor operation for all the parameters
+    :param target: a module or a list of modules
+    :param source: a module or a list of modules, matching target
+    """
+    with torch.no_grad():
+        torch._foreach_lerp_(module_parameters(target), module_parameters(source), tau)
 
 
 def hard_update(target, source):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+    with torch.no_grad():
+        torch._foreach_copy_(module_parameters(target), module_parameters(source))
+
+
+def compile_method(module, name):
+    """
+    Replaces a method of module by its torch.compile version on this instance, which
+    falls back to eager mode where compilation is unavailable or fails
+    """
+    method = getattr(module, name)
+    if not hasattr(torch, "compile") or not torch._dynamo.is_dynamo_supported():
+        print("torch.compile is unavailable, running", type(module).__name__, "eagerly")
+        return
+    compiled = torch.compile(method)
+
+    def call(*args, **kwargs):
+        nonlocal compiled
+        if compiled is not method:
+            try:
+                return compiled(*args, **kwargs)
+            except Exception as e:
+                print(
+                    "torch.compile failed, running",
+                    type(module).__name__,
+                    "eagerly:",
+                    e,
+                )
+                compiled = method
+        return method(*args, **kwargs)
+
+    setattr(module, name, call)
+
+
+def autocast_call(enabled, device_type, method, *args, dtype=torch.bfloat16):
+    """
+    Calls method under autocast when enabled, with the weights kept in float32 and
+    the outputs cast back to float32
+    """
+    with torch.autocast(device_type, dtype=dtype, enabled=enabled):
+        out = method(*args)
+    if isinstance(out, tuple):
+        return tuple(o.float() for o in out)
+    return out.float()
+
+
+def weighted_mse_loss(input, target, weights=None):
+    if weights is None:
+        return F.mse_loss(input, target)
+    return (weights * (input - target) ** 2).mean()
 
 
 class GeneticAgent:
-    def __init__(self, args: Parameters):
+    def __init__(self, args: Parameters, store, population=None, index=0):
+        """
+        :param population: PopulationTensor holding the weights of the actor in row
+            index, by default a new one with a single row
+        """
         self.args = args
+        if population is None:
+            population = PopulationTensor(args, 1)
+        self.population = population
+        self.index = index
 
-        self.actor = Actor(args)
-        self.old_actor = Actor(args)
-        self.temp_actor = Actor(args)
-        self.actor_optim = Adam(self.actor.parameters(), lr=1e-4)
-
-        self.buffer = replay_memory.ReplayMemory(self.args.individual_bs, args.device)
+        self.buffer = replay_memory.IndexReplayMemory(
+            self.args.individual_bs, args.device, store
+        )
         self.loss = nn.MSELoss()
 
+    # The modules and the optimizer are only created for gradient training, the
+    # evaluation and the variation operators work on the rows of the population
+    @property
+    def flat(self):
+        """The row of the population holding the weights of the actor"""
+        return self.population.params[self.index]
+
+    @cached_property
+    def actor(self):
+        return Actor(self.args, population=self.population, index=self.index)
+
+    @cached_property
+    def old_population(self):
+        return PopulationTensor(self.args, 1)
+
+    @cached_property
+    def old_actor(self):
+        return Actor(self.args, population=self.old_population)
+
+    def save_old_actor(self):
+        """Copies the weights into old_actor, the target of keep_consistency"""
+        self.old_population.set_rows([0], self.population.get_rows([self.index]))
+
+    @cached_property
+    def temp_actor(self):
+        return Actor(self.args)
+
+    @cached_property
+    def actor_optim(self):
+        return Adam(self.actor.parameters(), lr=1e-4)
+
     def keep_consistency(self, z_old, z_new):
         target_action = self.old_actor.select_action_from_z(z_old).detach()
         current_action = self.actor.select_action_from_z(z_new)
@@ -53,22 +151,21 @@ class GeneticAgent:
         self.actor_optim.step()
         return dt.data.cpu().numpy()
 
-    def update_parameters(self, batch, p1, p2, critic):
+    def update_parameters(self, batch, p1, p2, critic, state_embedding):
         state_batch, _, _, _, _ = batch
 
-        p1_action = p1(state_batch)
-        p2_action = p2(state_batch)
-        p1_q = critic.Q1(state_batch, p1_action).flatten()
-        p2_q = critic.Q1(state_batch, p2_action).flatten()
+        with torch.no_grad():
+            s_z = state_embedding.forward(state_batch)
+            p1_action, p2_action = ActorBank([p1, p2]).select_action_from_z(s_z)
+            p1_q = critic.Q1(state_batch, p1_action).flatten()
+            p2_q = critic.Q1(state_batch, p2_action).flatten()
 
         eps = 0.0
         action_batch = torch.cat(
             (p1_action[p1_q - p2_q > eps], p2_action[p2_q - p1_q >= eps])
-        ).detach()
-        state_batch = torch.cat(
-            (state_batch[p1_q - p2_q > eps], state_batch[p2_q - p1_q >= eps])
         )
-        actor_action = self.actor(state_batch)
+        s_z = torch.cat((s_z[p1_q - p2_q > eps], s_z[p2_q - p1_q >= eps]))
+        actor_action = self.actor.select_action_from_z(s_z)
 
         # Actor Update
         self.actor_optim.zero_grad()
@@ -116,20 +213,75 @@ class shared_state_embedding(nn.Module):
         return out
 
 
+class PopulationTensor:
+    """
+    Weights of the output heads of a population of actors, one row per actor in the
+    order of parameters_to_vector
+    """
+
+    def __init__(self, args, size):
+        self.args = args
+        num_params = args.ls * args.action_dim + args.action_dim
+        # The initialisation of nn.Linear, for the weights and the biases
+        bound = 1 / math.sqrt(args.ls)
+        self.params = torch.empty(size, num_params, device=args.device)
+        nn.init.uniform_(self.params, -bound, bound)
+
+    def __len__(self):
+        return len(self.params)
+
+    def weights(self, params=None):
+        """
+        :param params: rows of the population, all of them by default
+        :return: views of the weight matrices and biases of the rows
+        """
+        if params is None:
+            params = self.params
+        num_weights = params.shape[1] - self.args.action_dim
+        weight = params[:, :num_weights].view(len(params), -1, self.args.ls)
+        return weight, params[:, num_weights:]
+
+    def get_rows(self, indices):
+        """:return: a copy of the rows"""
+        return self.params[indices]
+
+    def set_rows(self, indices, params):
+        with torch.no_grad():
+            self.params[indices] = params
+
+
 class Actor(nn.Module):
-    def __init__(self, args, init=False):
+    def __init__(self, args, init=False, population=None, index=0):
+        """
+        :param population: PopulationTensor holding the weights in row index, by
+            default a new one with a single row
+        """
         super(Actor, self).__init__()
         self.args = args
         l2 = args.ls
         l3 = l2
+        if population is None:
+            population = PopulationTensor(args, 1)
+        self.population = population
+        self.index = index
+        # All the weights live in a row of the population and the parameters are
+        # views into it
+        self.flat = population.params[index]
         # Out
-        self.w_out = nn.Linear(l3, args.action_dim)
+        self.w_out = nn.Linear(l3, args.action_dim, device="meta")
+        num_weights = self.w_out.weight.numel()
+        self.w_out.weight = nn.Parameter(
+            self.flat[:num_weights].view(args.action_dim, l3)
+        )
+        self.w_out.bias = nn.Parameter(self.flat[num_weights:])
         # Init
         if init:
-            self.w_out.weight.data.mul_(0.1)
-            self.w_out.bias.data.mul_(0.1)
+            with torch.no_grad():
+                self.flat.mul_(0.1)
 
-        self.to(self.args.device)
+    def load_flat(self, flat):
+        with torch.no_grad():
+            self.flat.copy_(flat)
 
     def forward(self, input, state_embedding):
         s_z = state_embedding.forward(input)
@@ -144,10 +296,13 @@ class Actor(nn.Module):
         state = torch.FloatTensor(state.reshape(1, -1)).to(self.args.device)
         return self.forward(state, state_embedding).cpu().data.numpy().flatten()
 
-    def get_novelty(self, batch):
+    def get_novelty(self, batch, state_embedding):
         state_batch, action_batch, _, _, _ = batch
         novelty = torch.mean(
-            torch.sum((action_batch - self.forward(state_batch)) ** 2, dim=-1)
+            torch.sum(
+                (action_batch - self.forward(state_batch, state_embedding)) ** 2,
+                dim=-1,
+            )
         )
         return novelty.item()
 
@@ -166,41 +321,176 @@ class Actor(nn.Module):
 
     # function to grab current flattened neural network weights
     def extract_parameters(self):
-        tot_size = self.count_parameters()
-        pvec = torch.zeros(tot_size, dtype=torch.float32).to(self.args.device)
-        count = 0
-        for name, param in self.named_parameters():
-            if is_lnorm_key(name) or len(param.shape) != 2:
-                continue
-            sz = param.numel()
-            pvec[count : count + sz] = param.view(-1)
-            count += sz
-        return pvec.detach().clone()
+        return self.flat[: self.count_parameters()].detach().clone()
 
     # function to inject a flat vector of ANN parameters into the model's current neural network weights
     def inject_parameters(self, pvec):
-        count = 0
-        for name, param in self.named_parameters():
-            if is_lnorm_key(name) or len(param.shape) != 2:
-                continue
-            sz = param.numel()
-            raw = pvec[count : count + sz]
-            reshaped = raw.view(param.size())
-            param.data.copy_(reshaped.data)
-            count += sz
+        with torch.no_grad():
+            self.flat[: self.count_parameters()].copy_(pvec)
 
-    # count how many parameters are in the model
+    # count how many parameters are in the model (the weight matrix, without the bias)
     def count_parameters(self):
-        count = 0
-        for name, param in self.named_parameters():
-            if is_lnorm_key(name) or len(param.shape) != 2:
-                continue
-            count += param.numel()
-        return count
+        return self.w_out.weight.numel()
+
+
+class ActorBank:
+    """
+    Output heads of several actors sharing one state embedding, stacked so that the
+    embedding is computed once and every actor's action comes from one batched matmul.
+    The actors can also be GeneticAgents, which are used through their rows of the
+    population without creating their Actor modules.
+    """
+
+    def __init__(self, actors, flat=None):
+        """
+        :param flat: optional [num_actors, num_params] tensor holding the weights of
+            the actors, such as the storage their flat tensors are rows of
+        """
+        self.actors = list(actors)
+        self.flat = flat
+
+    def __len__(self):
+        return len(self.actors)
+
+    def __getitem__(self, index):
+        return self.actors[index]
+
+    def __iter__(self):
+        return iter(self.actors)
+
+    def subset(self, indices):
+        indices = list(indices)
+        if self.flat is None:
+            return ActorBank([self.actors[i] for i in indices])
+        return ActorBank([self.actors[i] for i in indices], self.flat[indices])
+
+    def snapshot(self):
+        """Returns a bank with a detached copy of the current weights"""
+        return ActorBank(self.actors, self.flat_parameters().detach().clone())
+
+    def flat_parameters(self):
+        """Parameters of every actor in the order of parameters_to_vector"""
+        if self.flat is not None:
+            return self.flat
+        return torch.stack([actor.flat for actor in self.actors])
+
+    def weights(self):
+        return self.actors[0].population.weights(self.flat_parameters())
+
+    def select_action_from_z(self, s_z, indices=None):
+        """
+        :param s_z: embedded states, either [batch, ls] shared by all the actors or
+            [num_actors, batch, ls] with a separate batch for every actor
+        :param indices: optional indices of the actors to use
+        :return: actions of shape [num_actors, batch, action_dim]
+        """
+        weight, bias = self.weights()
+        if indices is not None:
+            weight, bias = weight[indices], bias[indices]
+        if s_z.dim() == 2:
+            s_z = s_z.expand(len(weight), -1, -1)
+        return torch.baddbmm(bias.unsqueeze(1), s_z, weight.transpose(1, 2)).tanh()
+
+    def forward(self, state, state_embedding):
+        return self.select_action_from_z(state_embedding.forward(state))
+
+    def select_action(self, states, state_embedding, indices=None):
+        """
+        :param states: one state per actor (or per index)
+        :return: a numpy array with one action per actor
+        """
+        device = self.actors[0].args.device
+        with torch.no_grad():
+            state = torch.FloatTensor(np.asarray(states)).to(device)
+            s_z = state_embedding.forward(state).unsqueeze(1)
+            actions = self.select_action_from_z(s_z, indices)
+        return actions.squeeze(1).cpu().numpy()
+
+    def get_novelty(self, state_batch, action_batch, state_embedding):
+        """Novelty of every actor on the same batch, see Actor.get_novelty"""
+        with torch.no_grad():
+            actions = self.forward(state_batch, state_embedding)
+            novelty = torch.mean(torch.sum((action_batch - actions) ** 2, dim=-1), 1)
+        return novelty.cpu().numpy()
+
+
+class EnsembleLinear(nn.Module):
+    """
+    Linear layers of num_members independent networks with stacked weights, applied to
+    all the members with one batched matmul
+    """
+
+    def __init__(self, num_members, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(num_members, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(num_members, out_features))
+        # The initialisation of nn.Linear for every member
+        for weight in self.weight.data:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        bound = 1 / math.sqrt(in_features)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, input, member=None):
+        """
+        :param input: [batch, in_features] shared by the members or
+            [num_members, batch, in_features]
+        :param member: when given, only that member is applied to a [batch, in_features]
+            input
+        :return: [num_members, batch, out_features], or [batch, out_features] for member
+        """
+        if member is not None:
+            return F.linear(input, self.weight[member], self.bias[member])
+        input = input.expand(len(self.weight), -1, -1)
+        return torch.baddbmm(self.bias.unsqueeze(1), input, self.weight.transpose(1, 2))
+
+
+class EnsembleLayerNorm(nn.Module):
+    """LayerNorm of every member of an ensemble, normalising all of them at once"""
+
+    def __init__(self, num_members, features, eps=1e-6):
+        super(EnsembleLayerNorm, self).__init__()
+        self.weight = nn.Parameter(torch.ones(num_members, features))
+        self.bias = nn.Parameter(torch.zeros(num_members, features))
+        self.eps = eps
+
+    def forward(self, input, member=None):
+        """See EnsembleLinear.forward"""
+        if member is not None:
+            return F.layer_norm(
+                input,
+                input.shape[-1:],
+                self.weight[member],
+                self.bias[member],
+                self.eps,
+            )
+        out = F.layer_norm(input, input.shape[-1:], eps=self.eps)
+        return torch.addcmul(self.bias.unsqueeze(1), out, self.weight.unsqueeze(1))
+
+
+def stack_member_keys(members):
+    """
+    Returns a load_state_dict pre-hook converting the state dicts saved with a separate
+    layer per twin network to the stacked weights of the ensemble layers
+    :param members: the names of the separate layers of every ensemble layer
+    """
+
+    def hook(module, state_dict, prefix, *args):
+        for name, layers in members.items():
+            for key in ("weight", "bias"):
+                keys = [f"{prefix}{layer}.{key}" for layer in layers]
+                if all(k in state_dict for k in keys):
+                    state_dict[f"{prefix}{name}.{key}"] = torch.stack(
+                        [state_dict.pop(k) for k in keys]
+                    )
+
+    return hook
 
 
 class Critic(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, num_members=2):
+        """
+        :param num_members: number of Q networks, trained on the same targets
+        """
         super(Critic, self).__init__()
         self.args = args
 
@@ -208,87 +498,69 @@ class Critic(nn.Module):
         l2 = 300
         l3 = l2
 
+        # The twin Q networks are an ensemble, every layer holds the weights of both
         # Construct input interface (Hidden Layer 1)
-        self.w_l1 = nn.Linear(args.state_dim + args.action_dim, l1)
+        self.w_l1 = EnsembleLinear(num_members, args.state_dim + args.action_dim, l1)
         # Hidden Layer 2
-
-        self.w_l2 = nn.Linear(l1, l2)
+        self.w_l2 = EnsembleLinear(num_members, l1, l2)
         if self.args.use_ln:
-            self.lnorm1 = nn.LayerNorm(l1, eps=1e-6)
-            self.lnorm2 = nn.LayerNorm(l2, eps=1e-6)
+            self.lnorm1 = EnsembleLayerNorm(num_members, l1)
+            self.lnorm2 = EnsembleLayerNorm(num_members, l2)
 
         # Out
-        self.w_out = nn.Linear(l3, 1)
+        self.w_out = EnsembleLinear(num_members, l3, 1)
         self.w_out.weight.data.mul_(0.1)
         self.w_out.bias.data.mul_(0.1)
 
-        self.w_l3 = nn.Linear(args.state_dim + args.action_dim, l1)
-        # Hidden Layer 2
-        self.w_l4 = nn.Linear(l1, l2)
-        if self.args.use_ln:
-            self.lnorm3 = nn.LayerNorm(l1, eps=1e-6)
-            self.lnorm4 = nn.LayerNorm(l2, eps=1e-6)
-
-        # Out
-        self.w_out_2 = nn.Linear(l3, 1)
-        self.w_out_2.weight.data.mul_(0.1)
-        self.w_out_2.bias.data.mul_(0.1)
+        self.register_load_state_dict_pre_hook(
+            stack_member_keys(
+                {
+                    "w_l1": ["w_l1", "w_l3"],
+                    "w_l2": ["w_l2", "w_l4"],
+                    "w_out": ["w_out", "w_out_2"],
+                    "lnorm1": ["lnorm1", "lnorm3"],
+                    "lnorm2": ["lnorm2", "lnorm4"],
+                }
+            )
+        )
 
         self.to(self.args.device)
 
-    def forward(self, input, action):
+    def q_value(self, input, action, member=None):
+        """
+        :param member: when given, only the Q value of that member is computed
+        :return: [num_members, batch, 1], or [batch, 1] for member
+        """
         # Hidden Layer 1 (Input Interface)
         concat_input = torch.cat([input, action], -1)
 
-        out = self.w_l1(concat_input)
+        out = self.w_l1(concat_input, member)
         if self.args.use_ln:
-            out = self.lnorm1(out)
-
+            out = self.lnorm1(out, member)
         out = F.leaky_relu(out)
-        # Hidden Layer 2
-        out = self.w_l2(out)
-        if self.args.use_ln:
-            out = self.lnorm2(out)
-        out = F.leaky_relu(out)
-        # Output interface
-        out_1 = self.w_out(out)
-
-        out_2 = self.w_l3(concat_input)
-        if self.args.use_ln:
-            out_2 = self.lnorm3(out_2)
-        out_2 = F.leaky_relu(out_2)
 
         # Hidden Layer 2
-        out_2 = self.w_l4(out_2)
+        out = self.w_l2(out, member)
         if self.args.use_ln:
-            out_2 = self.lnorm4(out_2)
-        out_2 = F.leaky_relu(out_2)
+            out = self.lnorm2(out, member)
+        out = F.leaky_relu(out)
 
         # Output interface
-        out_2 = self.w_out_2(out_2)
+        return self.w_out(out, member)
 
-        return out_1, out_2
+    def forward(self, input, action):
+        """:return: a [batch, 1] Q value for every member"""
+        return tuple(self.q_value(input, action).unbind(0))
 
     def Q1(self, input, action):
-        concat_input = torch.cat([input, action], -1)
-
-        out = self.w_l1(concat_input)
-        if self.args.use_ln:
-            out = self.lnorm1(out)
-
-        out = F.leaky_relu(out)
-        # Hidden Layer 2
-        out = self.w_l2(out)
-        if self.args.use_ln:
-            out = self.lnorm2(out)
-        out = F.leaky_relu(out)
-        # Output interface
-        out_1 = self.w_out(out)
-        return out_1
+        return self.q_value(input, action, 0)
 
 
 class Policy_Value_Network(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, num_members=2):
+        """
+        :param num_members: number of policy encoders and Q networks, see Critic
+        """
         super(Policy_Value_Network, self).__init__()
         self.args = args
 
@@ -301,123 +573,97 @@ class Policy_Value_Network(nn.Module):
         # Construct input interface (Hidden Layer 1)
 
         if self.args.use_ln:
-            self.lnorm1 = nn.LayerNorm(l1, eps=1e-6)
-            self.lnorm2 = nn.LayerNorm(l2, eps=1e-6)
-            self.lnorm3 = nn.LayerNorm(l1, eps=1e-6)
-            self.lnorm4 = nn.LayerNorm(l2, eps=1e-6)
-        self.policy_w_l1 = nn.Linear(self.args.ls + 1, self.args.pr)
-        self.policy_w_l2 = nn.Linear(self.args.pr, self.args.pr)
-        self.policy_w_l3 = nn.Linear(self.args.pr, self.args.pr)
+            self.lnorm1 = EnsembleLayerNorm(num_members, l1)
+            self.lnorm2 = EnsembleLayerNorm(num_members, l2)
+        self.policy_w_l1 = EnsembleLinear(num_members, self.args.ls + 1, self.args.pr)
+        self.policy_w_l2 = EnsembleLinear(num_members, self.args.pr, self.args.pr)
+        self.policy_w_l3 = EnsembleLinear(num_members, self.args.pr, self.args.pr)
 
         if self.args.OFF_TYPE == 1:
             input_dim = self.args.state_dim + self.args.action_dim
         else:
             input_dim = self.args.ls
 
-        self.w_l1 = nn.Linear(input_dim + self.args.pr, l1)
+        self.w_l1 = EnsembleLinear(num_members, input_dim + self.args.pr, l1)
         # Hidden Layer 2
 
-        self.w_l2 = nn.Linear(l1, l2)
+        self.w_l2 = EnsembleLinear(num_members, l1, l2)
 
         # Out
-        self.w_out = nn.Linear(l3, 1)
+        self.w_out = EnsembleLinear(num_members, l3, 1)
         self.w_out.weight.data.mul_(0.1)
         self.w_out.bias.data.mul_(0.1)
 
-        self.policy_w_l4 = nn.Linear(self.args.ls + 1, self.args.pr)
-        self.policy_w_l5 = nn.Linear(self.args.pr, self.args.pr)
-        self.policy_w_l6 = nn.Linear(self.args.pr, self.args.pr)
-
-        self.w_l3 = nn.Linear(input_dim + self.args.pr, l1)
-        # Hidden Layer 2
-
-        self.w_l4 = nn.Linear(l1, l2)
-
-        # Out
-        self.w_out_2 = nn.Linear(l3, 1)
-        self.w_out_2.weight.data.mul_(0.1)
-        self.w_out_2.bias.data.mul_(0.1)
+        self.register_load_state_dict_pre_hook(
+            stack_member_keys(
+                {
+                    "policy_w_l1": ["policy_w_l1", "policy_w_l4"],
+                    "policy_w_l2": ["policy_w_l2", "policy_w_l5"],
+                    "policy_w_l3": ["policy_w_l3", "policy_w_l6"],
+                    "w_l1": ["w_l1", "w_l3"],
+                    "w_l2": ["w_l2", "w_l4"],
+                    "w_out": ["w_out", "w_out_2"],
+                    "lnorm1": ["lnorm1", "lnorm3"],
+                    "lnorm2": ["lnorm2", "lnorm4"],
+                }
+            )
+        )
 
         self.to(self.args.device)
 
-    def forward(self, input, param):
+    def encode_policies(self, param, member=None):
+        """
+        :param param: flat policy parameters, one row per policy
+        :return: [num_members, num_policies, pr], or [num_policies, pr] for member
+        """
         reshape_param = param.reshape([-1, self.args.ls + 1])
 
-        out_p = F.leaky_relu(self.policy_w_l1(reshape_param))
-        out_p = F.leaky_relu(self.policy_w_l2(out_p))
-        out_p = self.policy_w_l3(out_p)
-        out_p = out_p.reshape([-1, self.args.action_dim, self.args.pr])
-        out_p = torch.mean(out_p, dim=1)
-
-        # Hidden Layer 1 (Input Interface)
-        concat_input = torch.cat((input, out_p), 1)
-
-        # Hidden Layer 2
-        out = self.w_l1(concat_input)
-        if self.args.use_ln:
-            out = self.lnorm1(out)
-        out = F.leaky_relu(out)
-        out = self.w_l2(out)
-        if self.args.use_ln:
-            out = self.lnorm2(out)
-        out = F.leaky_relu(out)
-
-        # Output interface
-        out_1 = self.w_out(out)
-
-        out_p = F.leaky_relu(self.policy_w_l4(reshape_param))
-        out_p = F.leaky_relu(self.policy_w_l5(out_p))
-        out_p = self.policy_w_l6(out_p)
-        out_p = out_p.reshape([-1, self.args.action_dim, self.args.pr])
-        out_p = torch.mean(out_p, dim=1)
+        out_p = F.leaky_relu(self.policy_w_l1(reshape_param, member))
+        out_p = F.leaky_relu(self.policy_w_l2(out_p, member))
+        out_p = self.policy_w_l3(out_p, member)
+        out_p = out_p.unflatten(-2, (-1, self.args.action_dim))
+        return torch.mean(out_p, dim=-2)
+
+    def q_value(self, input, param, param_index=None, member=None):
+        """
+        :param param: flat policy parameters, one row per row of input, or one row per
+            distinct policy when param_index is given
+        :param param_index: the row of param used by every row of input, so that each
+            policy is encoded only once
+        :param member: when given, only the Q value of that member is computed
+        :return: [num_members, batch, 1], or [batch, 1] for member
+        """
+        out_p = self.encode_policies(param, member)
+        if param_index is not None:
+            out_p = out_p.index_select(-2, param_index)
+        if member is None:
+            input = input.expand(len(out_p), -1, -1)
 
         # Hidden Layer 1 (Input Interface)
-        concat_input = torch.cat((input, out_p), 1)
+        concat_input = torch.cat((input, out_p), -1)
 
         # Hidden Layer 2
-        out = self.w_l3(concat_input)
+        out = self.w_l1(concat_input, member)
         if self.args.use_ln:
-            out = self.lnorm3(out)
+            out = self.lnorm1(out, member)
         out = F.leaky_relu(out)
-
-        out = self.w_l4(out)
+        out = self.w_l2(out, member)
         if self.args.use_ln:
-            out = self.lnorm4(out)
+            out = self.lnorm2(out, member)
         out = F.leaky_relu(out)
 
         # Output interface
-        out_2 = self.w_out_2(out)
-
-        return out_1, out_2
-
-    def Q1(self, input, param):
-        reshape_param = param.reshape([-1, self.args.ls + 1])
-
-        out_p = F.leaky_relu(self.policy_w_l1(reshape_param))
-        out_p = F.leaky_relu(self.policy_w_l2(out_p))
-        out_p = self.policy_w_l3(out_p)
-        out_p = out_p.reshape([-1, self.args.action_dim, self.args.pr])
-        out_p = torch.mean(out_p, dim=1)
+        return self.w_out(out, member)
 
-        # Hidden Layer 1 (Input Interface)
-
-        # out_state = F.elu(self.w_state_l1(input))
-        # out_action = F.elu(self.w_action_l1(action))
-        concat_input = torch.cat((input, out_p), 1)
-
-        # Hidden Layer 2
-        out = self.w_l1(concat_input)
-        if self.args.use_ln:
-            out = self.lnorm1(out)
-        out = F.leaky_relu(out)
-        out = self.w_l2(out)
-        if self.args.use_ln:
-            out = self.lnorm2(out)
-        out = F.leaky_relu(out)
+    def forward(self, input, param, param_index=None):
+        """
+        See q_value
+        :return: a [batch, 1] Q value for every member
+        """
+        return tuple(self.q_value(input, param, param_index).unbind(0))
 
-        # Output interface
-        out_1 = self.w_out(out)
-        return out_1
+    def Q1(self, input, param, param_index=None):
+        return self.q_value(input, param, param_index, 0)
 
 
 def caculate_prob(score):
@@ -431,11 +677,15 @@ def caculate_prob(score):
 
 
 class TD3(object):
-    def __init__(self, args):
+    def __init__(self, args, store, population=None, index=0):
+        """
+        :param population: PopulationTensor holding the weights of the actor in row
+            index, by default a new one with a single row
+        """
         self.args = args
         self.max_action = 1.0
         self.device = args.device
-        self.actor = Actor(args, init=True)
+        self.actor = Actor(args, init=True, population=population, index=index)
         self.actor_target = Actor(args, init=True)
         self.actor_target.load_state_dict(self.actor.state_dict())
 
@@ -446,7 +696,9 @@ class TD3(object):
         self.critic_target.load_state_dict(self.critic.state_dict())
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=1e-3)
 
-        self.buffer = replay_memory.ReplayMemory(args.individual_bs, args.device)
+        self.buffer = replay_memory.IndexReplayMemory(
+            args.individual_bs, args.device, store
+        )
 
         self.PVN = Policy_Value_Network(args).to(self.device)
         self.PVN_Target = Policy_Value_Network(args).to(self.device)
@@ -463,6 +715,30 @@ class TD3(object):
         self.state_embedding_optimizer = torch.optim.Adam(
             self.state_embedding.parameters(), lr=1e-3
         )
+        for network in args.bf16:
+            if network not in ("embedding", "critic", "pvn"):
+                raise ValueError(f"Unknown network for bf16 autocast: {network}")
+        if args.compile:
+            self.compile()
+
+    def autocast(self, network, method, *args):
+        """
+        Calls a method of a network or its target in train, in bfloat16 autocast when
+        -bf16 selects the network. Other users of the networks run in float32.
+        :param network: (embedding) (critic) (pvn)
+        """
+        return autocast_call(network in self.args.bf16, self.device.type, method, *args)
+
+    def compile(self):
+        """Compiles the forward passes used in train, see compile_method"""
+        for module in (self.state_embedding, self.state_embedding_target):
+            compile_method(module, "forward")
+        for module in (self.actor, self.actor_target):
+            compile_method(module, "forward")
+            compile_method(module, "select_action_from_z")
+        for module in (self.critic, self.critic_target, self.PVN, self.PVN_Target):
+            compile_method(module, "forward")
+            compile_method(module, "Q1")
 
     def select_action(self, state):
         state = torch.FloatTensor(state.reshape(1, -1)).to(self.device)
@@ -494,56 +770,71 @@ class TD3(object):
         pv_loss_list = [np.array([0.0])]
         keep_c_loss = [0.0]
 
-        for it in range(iterations):
-            x, y, u, r, d, _, _ = replay_buffer.sample(batch_size)
-            state = torch.FloatTensor(x).to(self.device)
-            action = torch.FloatTensor(u).to(self.device)
-            next_state = torch.FloatTensor(y).to(self.device)
-            done = torch.FloatTensor(1 - d).to(self.device)
-            reward = torch.FloatTensor(r).to(self.device)
+        batches = sample_batches(
+            replay_buffer, iterations, batch_size, self.device, self.args
+        )
+        for it, (ind, batch) in enumerate(batches):
+            state, next_state, action, reward, d, _, _ = batch
+            done = 1 - d
+            weights = None
+            if self.args.per:
+                weights = torch.as_tensor(
+                    replay_buffer.importance_weights(ind),
+                    dtype=torch.float32,
+                    device=self.device,
+                ).view(-1, 1)
+
+            # One embedding pass per batch, shared by every loss below. The state
+            # embedding is only modified at the end of the iteration, and its gradient
+            # only comes from total_loss, so the other losses use it detached
+            update_policy = it % policy_freq == 0
+            s_z = None
+            if update_policy or (self.args.EA and self.args.OFF_TYPE != 1):
+                s_z = self.autocast("embedding", self.state_embedding.forward, state)
 
             if self.args.EA:
+                with torch.no_grad():
+                    next_s_z = self.autocast(
+                        "embedding", self.state_embedding.forward, next_state
+                    )
+                # Every row of the batch uses the single policy encoded by the PVN
+                param_index = torch.zeros(
+                    len(state), dtype=torch.long, device=self.device
+                )
                 if self.args.use_all:
                     use_actors = all_actor
                 else:
                     index = random.sample(list(range(self.args.pop_size + 1)), 1)[0]
-                    use_actors = [all_actor[index]]
+                    use_actors = all_actor.subset([index])
 
                 # off policy update
                 pv_loss = 0.0
-                for actor in use_actors:
-                    param = (
-                        nn.utils.parameters_to_vector(list(actor.parameters()))
-                        .data.cpu()
-                        .numpy()
-                    )
-                    param = torch.FloatTensor(param).to(self.device)
-                    param = param.repeat(len(state), 1)
+                for i, param in enumerate(use_actors.flat_parameters()):
+                    param = param.unsqueeze(0)
 
                     with torch.no_grad():
                         if self.args.OFF_TYPE == 1:
-                            input = torch.cat(
-                                [
-                                    next_state,
-                                    actor.forward(next_state, self.state_embedding),
-                                ],
-                                -1,
-                            )
+                            next_action = use_actors.select_action_from_z(next_s_z, [i])
+                            input = torch.cat([next_state, next_action[0]], -1)
                         else:
-                            input = self.state_embedding.forward(next_state)
-                        next_Q1, next_Q2 = self.PVN_Target.forward(input, param)
+                            input = next_s_z
+                        next_Q1, next_Q2 = self.autocast(
+                            "pvn", self.PVN_Target.forward, input, param, param_index
+                        )
                         next_target_Q = torch.min(next_Q1, next_Q2)
                         target_Q = reward + (done * discount * next_target_Q).detach()
 
                     if self.args.OFF_TYPE == 1:
                         input = torch.cat([state, action], -1)
                     else:
-                        input = self.state_embedding.forward(state)
+                        input = s_z.detach()
 
-                    current_Q1, current_Q2 = self.PVN.forward(input, param)
-                    pv_loss += F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-                        current_Q2, target_Q
+                    current_Q1, current_Q2 = self.autocast(
+                        "pvn", self.PVN.forward, input, param, param_index
                     )
+                    pv_loss += weighted_mse_loss(
+                        current_Q1, target_Q, weights
+                    ) + weighted_mse_loss(current_Q2, target_Q, weights)
 
                 self.PVN_optimizer.zero_grad()
                 pv_loss.backward()
@@ -554,26 +845,32 @@ class TD3(object):
                 pv_loss_list.append(0.0)
 
             # Select action according to policy and add clipped noise
-            noise = torch.FloatTensor(u).data.normal_(0, policy_noise).to(self.device)
+            noise = torch.randn_like(action) * policy_noise
             noise = noise.clamp(-noise_clip, noise_clip)
 
+            next_s_z_target = self.autocast(
+                "embedding", self.state_embedding_target.forward, next_state
+            )
             next_action = (
-                self.actor_target.forward(next_state, self.state_embedding_target)
-                + noise
+                self.actor_target.select_action_from_z(next_s_z_target) + noise
             ).clamp(-self.max_action, self.max_action)
 
             # Compute the target Q value
-            target_Q1, target_Q2 = self.critic_target(next_state, next_action)
+            target_Q1, target_Q2 = self.autocast(
+                "critic", self.critic_target.forward, next_state, next_action
+            )
             target_Q = torch.min(target_Q1, target_Q2)
             target_Q = reward + (done * discount * target_Q).detach()
 
             # Get current Q estimates
-            current_Q1, current_Q2 = self.critic(state, action)
+            current_Q1, current_Q2 = self.autocast(
+                "critic", self.critic.forward, state, action
+            )
 
             # Compute critic loss
-            critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-                current_Q2, target_Q
-            )
+            critic_loss = weighted_mse_loss(
+                current_Q1, target_Q, weights
+            ) + weighted_mse_loss(current_Q2, target_Q, weights)
 
             # Optimize the critic
             self.critic_optimizer.zero_grad()
@@ -582,12 +879,19 @@ class TD3(object):
             self.critic_optimizer.step()
             critic_loss_list.append(critic_loss.cpu().data.numpy().flatten())
 
+            if self.args.per:
+                replay_buffer.update_priorities(
+                    ind, (target_Q - current_Q1).detach().cpu().numpy()
+                )
+
             # Delayed policy updates
-            if it % policy_freq == 0:
+            if update_policy:
                 # Compute actor loss
-                s_z = self.state_embedding.forward(state)
-                actor_loss = -self.critic.Q1(
-                    state, self.actor.select_action_from_z(s_z)
+                actor_loss = -self.autocast(
+                    "critic",
+                    self.critic.Q1,
+                    state,
+                    self.actor.select_action_from_z(s_z.detach()),
                 ).mean()
                 # Optimize the actor
                 self.actor_optimizer.zero_grad()
@@ -595,9 +899,11 @@ class TD3(object):
                 nn.utils.clip_grad_norm_(self.actor.parameters(), 10)
                 self.actor_optimizer.step()
 
-                s_z = self.state_embedding.forward(state)
-                actor_loss = -self.critic.Q1(
-                    state, self.actor.select_action_from_z(s_z)
+                actor_loss = -self.autocast(
+                    "critic",
+                    self.critic.Q1,
+                    state,
+                    self.actor.select_action_from_z(s_z),
                 ).mean()
 
                 if self.args.EA:
@@ -607,24 +913,29 @@ class TD3(object):
                     new_actor_loss = 0.0
 
                     if evo_times > 0:
-                        for ind in index:
-                            actor = all_actor[ind]
-                            param = (
-                                nn.utils.parameters_to_vector(list(actor.parameters()))
-                                .data.cpu()
-                                .numpy()
+                        # All K actors share one embedding pass and one PVN pass
+                        bank = all_actor.subset(index).snapshot()
+                        param = bank.flat_parameters()
+                        param_index = torch.arange(
+                            len(bank), device=self.device
+                        ).repeat_interleave(len(state))
+                        if self.args.OFF_TYPE == 1:
+                            actions = bank.select_action_from_z(s_z)
+                            input = torch.cat(
+                                [state.expand(len(bank), -1, -1), actions], -1
+                            )
+                        else:
+                            input = s_z.expand(len(bank), -1, -1)
+                        input = input.reshape(len(param_index), -1)
+
+                        new_actor_loss = (
+                            -self.autocast(
+                                "pvn", self.PVN.Q1, input, param, param_index
                             )
-                            param = torch.FloatTensor(param).to(self.device)
-                            param = param.repeat(len(state), 1)
-                            if self.args.OFF_TYPE == 1:
-                                input = torch.cat(
-                                    [state, actor.forward(state, self.state_embedding)],
-                                    -1,
-                                )
-                            else:
-                                input = self.state_embedding.forward(state)
-
-                            new_actor_loss += -self.PVN.Q1(input, param).mean()
+                            .view(len(bank), -1)
+                            .mean(1)
+                            .sum()
+                        )
 
                     total_loss = (
                         self.args.actor_alpha * actor_loss
@@ -639,34 +950,16 @@ class TD3(object):
                 self.state_embedding_optimizer.step()
                 # Update the frozen target models
 
-                for param, target_param in zip(
-                    self.state_embedding.parameters(),
-                    self.state_embedding_target.parameters(),
-                ):
-                    target_param.data.copy_(
-                        tau * param.data + (1 - tau) * target_param.data
-                    )
-
-                for param, target_param in zip(
-                    self.critic.parameters(), self.critic_target.parameters()
-                ):
-                    target_param.data.copy_(
-                        tau * param.data + (1 - tau) * target_param.data
-                    )
-
-                for param, target_param in zip(
-                    self.actor.parameters(), self.actor_target.parameters()
-                ):
-                    target_param.data.copy_(
-                        tau * param.data + (1 - tau) * target_param.data
-                    )
-
-                for param, target_param in zip(
-                    self.PVN.parameters(), self.PVN_Target.parameters()
-                ):
-                    target_param.data.copy_(
-                        tau * param.data + (1 - tau) * target_param.data
-                    )
+                soft_update(
+                    [
+                        self.state_embedding_target,
+                        self.critic_target,
+                        self.actor_target,
+                        self.PVN_Target,
+                    ],
+                    [self.state_embedding, self.critic, self.actor, self.PVN],
+                    tau,
+                )
 
                 actor_loss_list.append(actor_loss.cpu().data.numpy().flatten())
                 pre_loss_list.append(0.0)
@@ -1,11 +1,12 @@
 import random
 import numpy as np
-from core.ddpg import GeneticAgent, hard_update
+from core.ddpg import ActorBank, GeneticAgent
 from typing import List
 import fastrand
 import torch
 import torch.distributions as dist
-from core.mod_utils import is_lnorm_key
+from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from parameters import Parameters
 import os
 
@@ -35,6 +36,11 @@ class SSNE:
             self.num_elitists = 1
 
         self.rl_policy = None
+        # Children distilled together by distilation_crossover_population, which
+        # bounds its cache to about 160 MB for buffers of 8000 transitions
+        self.distil_group_size = 16
+        # Embedded states of the behavioural distances
+        self.probe_s_z = None
         self.selection_stats = {
             "elite": 0,
             "selected": 0,
@@ -90,39 +96,7 @@ class SSNE:
                 test_score_p2 += episode["reward"]
             test_score_p2 /= trials
 
-        b_1 = None
-        b_2 = None
-        for param1, param2 in zip(gene1.actor.parameters(), gene2.actor.parameters()):
-            # References to the variable tensors
-            W1 = param1.data
-            W2 = param2.data
-            if len(W1.shape) == 1:
-                b_1 = W1
-                b_2 = W2
-
-        for param1, param2 in zip(gene1.actor.parameters(), gene2.actor.parameters()):
-            # References to the variable tensors
-            W1 = param1.data
-            W2 = param2.data
-
-            if len(W1.shape) == 2:  # Weights no bias
-                num_variables = W1.shape[0]
-                # Crossover opertation [Indexed by row]
-                num_cross_overs = fastrand.pcg32bounded(
-                    num_variables * 2
-                )  # Lower bounded on full swaps
-                for i in range(num_cross_overs):
-                    receiver_choice = (
-                        random.random()
-                    )  # Choose which gene to receive the perturbation
-                    if receiver_choice < 0.5:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W1[ind_cr, :] = W2[ind_cr, :]
-                        b_1[ind_cr] = b_2[ind_cr]
-                    else:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W2[ind_cr, :] = W1[ind_cr, :]
-                        b_2[ind_cr] = b_1[ind_cr]
+        self.crossover_pairs([(gene1, gene2)])
 
         # Evaluate the children
         if self.args.opstat and self.stats.should_log():
@@ -165,28 +139,183 @@ class SSNE:
                 }
             )
 
-    def distilation_crossover(self, gene1: GeneticAgent, gene2: GeneticAgent):
-        new_agent = GeneticAgent(self.args)
-        new_agent.buffer.add_latest_from(gene1.buffer, self.args.individual_bs // 2)
-        new_agent.buffer.add_latest_from(gene2.buffer, self.args.individual_bs // 2)
-        new_agent.buffer.shuffle()
+    def crossover_pairs(self, pairs):
+        """
+        Crossover of every pair of genes at once, as crossover_inplace without the
+        operator statistics. No gene can be in two pairs
+        """
+        genes1, genes2 = zip(*pairs)
+        flat1 = get_params(genes1)
+        flat2 = get_params(genes2)
+        weight1, bias1 = genes1[0].population.weights(flat1)
+        weight2, bias2 = genes2[0].population.weights(flat2)
+        num_pairs, num_rows = bias1.shape
+        device = flat1.device
+
+        # Schedule of up to 2 * num_rows row copies per pair, each from a random gene
+        # to the other one. After its first copy a row is the same in both genes, so
+        # the first copy of every row decides the result
+        max_steps = 2 * num_rows
+        num_steps = torch.randint(0, max_steps, (num_pairs, 1), device=device)
+        rows = torch.randint(0, num_rows, (num_pairs, max_steps), device=device)
+        to_gene1 = torch.rand(num_pairs, max_steps, device=device) < 0.5
+        steps = torch.arange(max_steps, device=device).expand(num_pairs, -1)
+        steps = torch.where(steps < num_steps, steps, max_steps)
+        first_step = torch.full((num_pairs, num_rows), max_steps, device=device)
+        first_step.scatter_reduce_(1, rows, steps, "amin")
+        crossed = first_step < max_steps
+        to_gene1 = to_gene1.gather(1, first_step.clamp(max=max_steps - 1))
+
+        for W1, W2 in ((weight1, weight2), (bias1.unsqueeze(-1), bias2.unsqueeze(-1))):
+            W = torch.where(to_gene1.unsqueeze(-1), W2, W1)
+            W1.copy_(torch.where(crossed.unsqueeze(-1), W, W1))
+            W2.copy_(torch.where(crossed.unsqueeze(-1), W, W2))
+
+        set_params(genes1, flat1)
+        set_params(genes2, flat2)
+
+    def distilation_crossover_population(self, pairs, children):
+        """
+        Distillation crossover of every (gene1, gene2) pair at once. The children are
+        trained together in their rows of the population, each on batches of its own
+        buffer with the objective of GeneticAgent.update_parameters
+        :param pairs: list of (gene1, gene2) parents, the children start as gene2
+        :param children: genes replaced by the children, one per pair, which may also
+            be parents as everything is read from the parents first
+        :return: a [steps, num_children] array of the MSE losses of the children, zero
+            once a child ran all its steps
+        """
+        latest = [
+            (
+                gene1.buffer.get_latest(self.args.individual_bs // 2),
+                gene2.buffer.get_latest(self.args.individual_bs // 2),
+            )
+            for gene1, gene2 in pairs
+        ]
+        parent_genes = [gene for pair in pairs for gene in pair]
+        parents = ActorBank(parent_genes, get_params(parent_genes))
+        student = get_params([gene2 for _, gene2 in pairs])
+        for child, (seqs1, seqs2) in zip(children, latest):
+            child.buffer.reset()
+            child.buffer.extend(seqs1)
+            child.buffer.extend(seqs2)
+            child.buffer.shuffle()
 
-        hard_update(new_agent.actor, gene2.actor)
-        batch_size = min(128, len(new_agent.buffer))
-        iters = len(new_agent.buffer) // batch_size
         losses = []
-        for epoch in range(12):
-            for i in range(iters):
-                batch = new_agent.buffer.sample(batch_size)
-                losses.append(
-                    new_agent.update_parameters(
-                        batch, gene1.actor, gene2.actor, self.critic
-                    )
+        for start in range(0, len(children), self.distil_group_size):
+            group = range(start, min(start + self.distil_group_size, len(children)))
+            losses.append(
+                self.distil_children(
+                    [children[i] for i in group],
+                    [parents.subset([2 * i, 2 * i + 1]) for i in group],
+                    student[start : group.stop].clone(),
                 )
+            )
+        steps = max(len(group_losses) for group_losses in losses)
+        return np.concatenate(
+            [
+                np.pad(group_losses, ((0, steps - len(group_losses)), (0, 0)))
+                for group_losses in losses
+            ],
+            axis=1,
+        )
 
-        if self.args.opstat and self.stats.should_log():
+    def distil_children(self, children, parents, student):
+        """
+        Trains a group of children of distilation_crossover_population together. The
+        embedded states and the targets of every transition of their buffers are
+        cached, (ls + action_dim) floats per transition and child
+        :param parents: an ActorBank with the weights of the two parents of each child
+        :param student: [num_children, num_params] starting weights of the children
+        :return: a [steps, num_children] array of the MSE losses of the children
+        """
+        num_children = len(children)
+        # Every child samples min(128, len(buffer)) transitions for 12 epochs of its
+        # buffer, the batches are padded to the largest one
+        seqs = [child.buffer.get_latest(child.buffer.capacity) for child in children]
+        sizes = np.array([len(s) for s in seqs])
+        batch_sizes = np.minimum(128, sizes)
+        steps = 12 * (sizes // np.maximum(batch_sizes, 1))
+        if steps.max() == 0:
+            set_params(children, student)
+            return np.zeros((0, num_children))
+        batch_size = int(batch_sizes.max())
+
+        device = self.args.device
+        s_z = torch.zeros(num_children, sizes.max(), self.args.ls, device=device)
+        target = torch.zeros(
+            num_children, sizes.max(), self.args.action_dim, device=device
+        )
+        for i, pair in enumerate(parents):
+            if sizes[i] > 0:
+                s_z[i, : sizes[i]], target[i, : sizes[i]] = self.distilation_targets(
+                    children[i].buffer, seqs[i], pair
+                )
+        live = torch.arange(sizes.max(), device=device) < torch.as_tensor(
+            sizes, device=device
+        ).unsqueeze(1)
+        rows = torch.arange(batch_size, device=device) < torch.as_tensor(
+            batch_sizes, device=device
+        ).unsqueeze(1)
+        child_index = torch.arange(num_children, device=device).unsqueeze(1)
+        num_actions = torch.as_tensor(batch_sizes * self.args.action_dim, device=device)
+        student.requires_grad_()
+        students = ActorBank(children, student)
+        optim = torch.optim.Adam([student], lr=1e-4)
+        losses = []
+        for step in range(steps.max()):
+            active = torch.as_tensor(step < steps, device=device)
+            # Distinct transitions for every child, as random.sample in sample
+            keys = torch.rand(live.shape, device=device).masked_fill_(~live, -1.0)
+            ind = keys.topk(batch_size, dim=1).indices
+            actor_action = students.select_action_from_z(s_z[child_index, ind])
+            mask = (rows & active.unsqueeze(1)).unsqueeze(2)
+            sq = ((actor_action - target[child_index, ind]) ** 2 * mask).sum((1, 2))
+            policy_loss = sq + (actor_action**2 * mask).sum((1, 2)) / num_actions
+
+            optim.zero_grad()
+            policy_loss.sum().backward()
+            # Adam moves rows with zero gradients too, the finished children are kept
+            finished = student.detach()[~active].clone()
+            optim.step()
+            with torch.no_grad():
+                student[~active] = finished
+            losses.append(sq.detach() / num_actions)
+
+        set_params(children, student.detach())
+        return torch.stack(losses).cpu().numpy()
+
+    @torch.no_grad()
+    def distilation_targets(self, buffer, seqs, parents):
+        """
+        The parents, the critic and the state embedding do not change during the
+        distillation, so the targets of the student are computed once per transition
+        :param seqs: sequence numbers of transitions in the store of buffer
+        :param parents: an ActorBank of gene1 and gene2
+        :return: the embedded states and the actions of the parent with the higher
+            Q1 (ties go to gene2), one row per transition
+        """
+        state, _, _, _, _ = buffer.gather(seqs)
+        s_z = self.state_embedding.forward(state)
+        p1_action, p2_action = parents.select_action_from_z(s_z)
+        p1_q = self.critic.Q1(state, p1_action)
+        p2_q = self.critic.Q1(state, p2_action)
+        return s_z, torch.where(p1_q > p2_q, p1_action, p2_action)
+
+    def distilation_crossover(
+        self, gene1: GeneticAgent, gene2: GeneticAgent, child: GeneticAgent = None
+    ):
+        """
+        :param child: gene replaced by the child, by default a new GeneticAgent
+        :return: the child
+        """
+        if child is None:
+            child = GeneticAgent(self.args, gene1.buffer.store)
+        should_log = self.args.opstat and self.stats.should_log()
+        trials = 5
+        if should_log:
+            # The parents are evaluated first, the child may replace one of them
             test_score_p1 = 0
-            trials = 5
             for eval in range(trials):
                 episode = self.evaluate(
                     gene1,
@@ -208,10 +337,13 @@ class SSNE:
                 test_score_p2 += episode["reward"]
             test_score_p2 /= trials
 
+        losses = self.distilation_crossover_population([(gene1, gene2)], [child])
+
+        if should_log:
             test_score_c = 0
             for eval in range(trials):
                 episode = self.evaluate(
-                    new_agent,
+                    child,
                     is_render=False,
                     is_action_noise=False,
                     store_transition=False,
@@ -223,7 +355,7 @@ class SSNE:
                 print(
                     "==================== Distillation Crossover ======================"
                 )
-                print("MSE Loss:", np.mean(losses[-40:]))
+                print("MSE Loss:", np.mean(losses[-40:, 0]))
                 print("Parent 1", test_score_p1)
                 print("Parent 2", test_score_p2)
                 print("Crossover performance: ", test_score_c)
@@ -236,7 +368,7 @@ class SSNE:
                 }
             )
 
-        return new_agent
+        return child
 
     def mutate_inplace(self, gene: GeneticAgent):
         trials = 5
@@ -249,58 +381,7 @@ class SSNE:
                 test_score_p += episode["reward"]
             test_score_p /= trials
 
-        mut_strength = 0.1
-        super_mut_strength = 10
-        super_mut_prob = self.prob_reset_and_sup
-        reset_prob = super_mut_prob + self.prob_reset_and_sup
-
-        num_params = len(list(gene.actor.parameters()))
-        ssne_probabilities = np.random.uniform(0, 1, num_params) * 2
-        model_params = gene.actor.state_dict()
-
-        for i, key in enumerate(model_params):  # Mutate each param
-            if is_lnorm_key(key):
-                continue
-
-            # References to the variable keys
-            W = model_params[key]
-            if len(W.shape) == 2:  # Weights, no bias
-                ssne_prob = ssne_probabilities[i]
-
-                if random.random() < ssne_prob:
-                    num_variables = W.shape[0]
-                    # Crossover opertation [Indexed by row]
-                    for index in range(num_variables):
-                        # ind_dim1 = fastrand.pcg32bounded(W.shape[0])
-                        # ind_dim2 = fastrand.pcg32bounded(W.shape[-1])
-
-                        random_num_num = random.random()
-                        if random_num_num < 1.0:
-                            # print(W)
-                            index_list = random.sample(
-                                range(W.shape[1]), int(W.shape[1] * self.frac)
-                            )
-                            random_num = random.random()
-                            if (
-                                random_num < super_mut_prob
-                            ):  # Super Mutation probability
-                                for ind in index_list:
-                                    W[index, ind] += random.gauss(
-                                        0, super_mut_strength * W[index, ind]
-                                    )
-                            elif random_num < reset_prob:  # Reset probability
-                                for ind in index_list:
-                                    W[index, ind] = random.gauss(0, 1)
-                            else:  # mutation even normal
-                                for ind in index_list:
-                                    W[index, ind] += random.gauss(
-                                        0, mut_strength * W[index, ind]
-                                    )
-
-                            # Regularization hard limit
-                            W[index, :] = np.clip(
-                                W[index, :], a_min=-1000000, a_max=1000000
-                            )
+        self.mutate_population([gene])
 
         if self.stats.should_log():
             test_score_c = 0
@@ -323,6 +404,56 @@ class SSNE:
                 print("Fitness before: ", test_score_p)
                 print("Fitness after: ", test_score_c)
 
+    def mutate_population(self, genes: List[GeneticAgent]):
+        """
+        Mutates the weights of several genes at once, as mutate_inplace without the
+        operator statistics
+        """
+        flat = get_params(genes)
+        weight, _ = genes[0].population.weights(flat)
+        self.mutate_weights(weight)
+        set_params(genes, flat)
+
+    def mutate_weights(self, weight):
+        """
+        Mutates, in place and with all the random draws made in bulk, the weight
+        matrices of a stack of genes. Each one is mutated with a random probability and
+        then every row perturbs a random frac of its elements, with a super mutation,
+        a reset or a normal mutation chosen for the whole row
+        :param weight: [num_genes, rows, columns]
+        """
+        mut_strength = 0.1
+        super_mut_strength = 10
+        super_mut_prob = self.prob_reset_and_sup
+        reset_prob = super_mut_prob + self.prob_reset_and_sup
+
+        num_genes, num_rows, num_columns = weight.shape
+        device = weight.device
+        ssne_prob = torch.rand(num_genes, device=device) * 2
+        mutated = torch.rand(num_genes, device=device) < ssne_prob
+
+        # The same number of distinct elements in every row
+        num_elements = int(num_columns * self.frac)
+        index = torch.rand(weight.shape, device=device).argsort(-1)[..., :num_elements]
+        mask = torch.zeros(weight.shape, dtype=torch.bool, device=device)
+        mask.scatter_(-1, index, True)
+        mask &= mutated.view(-1, 1, 1)
+
+        random_num = torch.rand(num_genes, num_rows, 1, device=device)
+        noise = torch.randn(weight.shape, device=device)
+        strength = torch.where(
+            random_num < super_mut_prob, super_mut_strength, mut_strength
+        )
+        new_weight = torch.where(
+            (random_num >= super_mut_prob) & (random_num < reset_prob),
+            noise,
+            weight + noise * strength * weight,
+        )
+        weight.copy_(torch.where(mask, new_weight, weight))
+
+        # Regularization hard limit
+        weight.clamp_(-1000000, 1000000)
+
     def proximal_mutate(self, gene: GeneticAgent, mag):
         # Based on code from https://github.com/uber-research/safemutations
         trials = 5
@@ -335,47 +466,9 @@ class SSNE:
                 test_score_p += episode["reward"]
             test_score_p /= trials
 
-        model = gene.actor
-
-        batch = gene.buffer.sample(min(self.args.mutation_batch_size, len(gene.buffer)))
-        state, _, _, _, _ = batch
-        output = model(state, self.state_embedding)
-
-        params = model.extract_parameters()
-        tot_size = model.count_parameters()
-        num_outputs = output.size()[1]
-
-        if self.args.mutation_noise:
-            mag_dist = dist.Normal(self.args.mutation_mag, 0.02)
-            mag = mag_dist.sample()
-
-        # initial perturbation
-        normal = dist.Normal(torch.zeros_like(params), torch.ones_like(params) * mag)
-        delta = normal.sample()
-        # uniform = delta.clone().detach().data.uniform_(0, 1)
-        # delta[uniform > 0.1] = 0.0
-
-        # we want to calculate a jacobian of derivatives of each output's sensitivity to each parameter
-        jacobian = torch.zeros(num_outputs, tot_size).to(self.args.device)
-        grad_output = torch.zeros(output.size()).to(self.args.device)
-
-        # do a backward pass for each output
-        for i in range(num_outputs):
-            model.zero_grad()
-            grad_output.zero_()
-            grad_output[:, i] = 1.0
-
-            output.backward(grad_output, retain_graph=True)
-            jacobian[i] = model.extract_grad()
-
-        # summed gradients sensitivity
-        scaling = torch.sqrt((jacobian**2).sum(0))
-        scaling[scaling == 0] = 1.0
-        scaling[scaling < 0.01] = 0.01
-        delta /= scaling
-        new_params = params + delta
-
-        model.inject_parameters(new_params)
+        params = get_params([gene])
+        self.proximal_mutate_population([gene], mag)
+        new_params = get_params([gene])
 
         if self.stats.should_log():
             test_score_c = 0
@@ -402,13 +495,61 @@ class SSNE:
                     torch.mean(torch.abs(new_params - params)).item(),
                 )
 
+    def proximal_mutate_population(self, genes: List[GeneticAgent], mag):
+        """
+        Safe mutation of several genes at once, as proximal_mutate without the operator
+        statistics. The Gaussian perturbation of every weight is scaled down by the
+        sensitivity of the actions on a batch of the gene's states to that weight
+        """
+        states = []
+        for gene in genes:
+            batch_size = min(self.args.mutation_batch_size, len(gene.buffer))
+            if batch_size > 0:
+                state, _, _, _, _ = gene.buffer.sample(batch_size)
+            else:
+                state = torch.zeros(0, self.args.state_dim, device=self.args.device)
+            states.append(state)
+        with torch.no_grad():
+            s_z = self.state_embedding.forward(torch.cat(states))
+        # Zero embeddings do not change the sensitivity to the weights, so smaller
+        # batches are padded with them
+        s_z = pad_sequence(
+            s_z.split([len(state) for state in states]), batch_first=True
+        )
+
+        flat = get_params(genes)
+        weight, bias = genes[0].population.weights(flat)
+        scaling = self.output_sensitivity(weight, bias, s_z)
+        scaling[scaling == 0] = 1.0
+        scaling[scaling < 0.01] = 0.01
+
+        if self.args.mutation_noise:
+            mag = dist.Normal(self.args.mutation_mag, 0.02).sample((len(genes), 1))
+        delta = torch.randn_like(scaling) * mag
+        flat[:, : scaling.shape[1]] += delta / scaling
+        set_params(genes, flat)
+
+    @staticmethod
+    def output_sensitivity(weight, bias, s_z):
+        """
+        :param weight: [num_genes, action_dim, ls] weights of the actors
+        :param bias: [num_genes, action_dim]
+        :param s_z: [num_genes, batch, ls] embedded states of every gene
+        :return: [num_genes, num_weights], for every weight the norm of the gradients of
+            all the actions summed over the batch
+        """
+
+        def summed_actions(weight, bias, s_z):
+            # Actor.select_action_from_z
+            return F.linear(s_z, weight, bias).tanh().sum(0)
+
+        jacobian = torch.func.vmap(torch.func.jacrev(summed_actions))(weight, bias, s_z)
+        return torch.sqrt((jacobian**2).sum(1)).flatten(1)
+
     def clone(
         self, master: GeneticAgent, replacee: GeneticAgent
     ):  # Replace the replacee individual with master
-        for target_param, source_param in zip(
-            replacee.actor.parameters(), master.actor.parameters()
-        ):
-            target_param.data.copy_(source_param.data)
+        set_params([replacee], get_params([master]))
         replacee.buffer.reset()
         replacee.buffer.add_content_of(master.buffer)
 
@@ -427,24 +568,39 @@ class SSNE:
                     groups.append((first, second, fitness[first] + fitness[second]))
         return sorted(groups, key=lambda group: group[2], reverse=True)
 
-    @staticmethod
-    def get_distance(gene1: GeneticAgent, gene2: GeneticAgent):
-        batch_size = min(256, min(len(gene1.buffer), len(gene2.buffer)))
-        batch_gene1 = gene1.buffer.sample_from_latest(batch_size, 1000)
-        batch_gene2 = gene2.buffer.sample_from_latest(batch_size, 1000)
-
-        return gene1.actor.get_novelty(batch_gene2) + gene2.actor.get_novelty(
-            batch_gene1
+    def draw_probe_states(self, genes: List[GeneticAgent]):
+        """
+        Draws the states shared by the distances of a generation, up to 256 of the
+        latest 1000 transitions of the genes, embedded with the current embedding
+        """
+        seqs = np.unique(
+            np.concatenate([gene.buffer.get_latest(1000) for gene in genes])
         )
-
-    @staticmethod
-    def sort_groups_by_distance(genomes, pop):
+        seqs = seqs[np.random.choice(len(seqs), min(256, len(seqs)), replace=False)]
+        self.probe_s_z = None
+        if len(seqs) > 0:
+            state, _, _, _, _ = genes[0].buffer.gather(seqs)
+            with torch.no_grad():
+                self.probe_s_z = self.state_embedding.forward(state)
+
+    def distance_matrix(self, genes: List[GeneticAgent]):
+        """
+        Behavioural distances between the genes, the mean squared distance between
+        their actions on the probe states
+        :return: a [num_genes, num_genes] tensor
+        """
+        if self.probe_s_z is None:
+            return torch.zeros(len(genes), len(genes))
+        with torch.no_grad():
+            actions = ActorBank(genes).select_action_from_z(self.probe_s_z)
+        return ((actions.unsqueeze(1) - actions.unsqueeze(0)) ** 2).sum(-1).mean(-1)
+
+    def sort_groups_by_distance(self, genomes, pop):
+        distances = self.distance_matrix([pop[i] for i in genomes]).cpu().numpy()
         groups = []
         for i, first in enumerate(genomes):
-            for second in genomes[i + 1 :]:
-                groups.append(
-                    (second, first, SSNE.get_distance(pop[first], pop[second]))
-                )
+            for j in range(i + 1, len(genomes)):
+                groups.append((genomes[j], first, distances[i, j]))
         return sorted(groups, key=lambda group: group[2], reverse=True)
 
     def epoch(self, pop: List[GeneticAgent], fitness_evals):
@@ -478,6 +634,9 @@ class SSNE:
             elif self.rl_policy in unselects:
                 self.selection_stats["discarded"] += 1.0
             self.rl_policy = None
+        # Children distilled together by distilation_crossover_population, which
+        # bounds its cache to about 160 MB for buffers of 8000 transitions
+        self.distil_group_size = 16
 
         # Elitism step, assigning elite candidates to some unselects
         for i in elitist_index:
@@ -495,27 +654,43 @@ class SSNE:
                     new_elitists + offsprings, fitness_evals
                 )
             elif self.args.distil_type == "dist":
-                sorted_groups = SSNE.sort_groups_by_distance(
-                    new_elitists + offsprings, pop
-                )
+                genomes = new_elitists + offsprings
+                self.draw_probe_states([pop[i] for i in genomes])
+                sorted_groups = self.sort_groups_by_distance(genomes, pop)
             else:
                 raise NotImplementedError("Unknown distilation type")
+            pairs = []
             for i, unselected in enumerate(unselects):
                 first, second, _ = sorted_groups[i % len(sorted_groups)]
                 if fitness_evals[first] < fitness_evals[second]:
                     first, second = second, first
-                self.clone(
-                    self.distilation_crossover(pop[first], pop[second]), pop[unselected]
-                )
+                pairs.append((pop[first], pop[second]))
+            children = [pop[unselected] for unselected in unselects]
+            # The children replace the unselected genes in place, all at once
+            if self.args.opstat and self.stats.should_log():
+                for pair, child in zip(pairs, children):
+                    self.distilation_crossover(*pair, child)
+            elif pairs:
+                self.distilation_crossover_population(pairs, children)
         else:
             if len(unselects) % 2 != 0:  # Number of unselects left should be even
                 unselects.append(unselects[fastrand.pcg32bounded(len(unselects))])
+            # Pairs are crossed together until a gene of a pending pair is cloned again
+            pairs = []
             for i, j in zip(unselects[0::2], unselects[1::2]):
+                if any(k in pair for pair in pairs for k in (i, j)):
+                    self.crossover_pairs([(pop[k], pop[l]) for k, l in pairs])
+                    pairs = []
                 off_i = random.choice(new_elitists)
                 off_j = random.choice(offsprings)
                 self.clone(master=pop[off_i], replacee=pop[i])
                 self.clone(master=pop[off_j], replacee=pop[j])
-                self.crossover_inplace(pop[i], pop[j])
+                if self.args.opstat and self.stats.should_log():
+                    self.crossover_inplace(pop[i], pop[j])
+                else:
+                    pairs.append((i, j))
+            if pairs:
+                self.crossover_pairs([(pop[k], pop[l]) for k, l in pairs])
 
         # Crossover for selected offsprings
         for i in offsprings:
@@ -523,16 +698,23 @@ class SSNE:
                 others = offsprings.copy()
                 others.remove(i)
                 off_j = random.choice(others)
-                self.clone(self.distilation_crossover(pop[i], pop[off_j]), pop[i])
+                self.distilation_crossover(pop[i], pop[off_j], pop[i])
 
         # Mutate all genes in the population except the new elitists
+        mutated = []
         for i in range(self.population_size):
             if i not in new_elitists:  # Spare the new elitists
                 if random.random() < self.args.mutation_prob:
-                    if self.args.proximal_mut:
+                    if not self.stats.should_log():
+                        mutated.append(pop[i])
+                    elif self.args.proximal_mut:
                         self.proximal_mutate(pop[i], mag=self.args.mutation_mag)
                     else:
                         self.mutate_inplace(pop[i])
+        if mutated and self.args.proximal_mut:
+            self.proximal_mutate_population(mutated, self.args.mutation_mag)
+        elif mutated:
+            self.mutate_population(mutated)
 
         if self.stats.should_log():
             self.stats.log()
@@ -540,6 +722,27 @@ class SSNE:
         return new_elitists[0]
 
 
+def get_params(genes: List[GeneticAgent]):
+    """
+    :return: a [num_genes, num_params] copy of the weights of the genes, gathered with
+        one index when they share a PopulationTensor
+    """
+    population = genes[0].population
+    if all(gene.population is population for gene in genes):
+        return population.get_rows([gene.index for gene in genes])
+    return torch.cat([gene.population.get_rows([gene.index]) for gene in genes])
+
+
+def set_params(genes: List[GeneticAgent], params):
+    """Writes the rows of params into the weights of the genes, see get_params"""
+    population = genes[0].population
+    if all(gene.population is population for gene in genes):
+        population.set_rows([gene.index for gene in genes], params)
+    else:
+        for gene, row in zip(genes, params):
+            gene.population.set_rows([gene.index], row.unsqueeze(0))
+
+
 def unsqueeze(array, axis=1):
     if axis == 0:
         return np.reshape(array, (1, len(array)))
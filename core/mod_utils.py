@@ -87,57 +87,67 @@ class Memory:  # stored as ( s, a, r, s_ ) in SumTree
 
 
 class SumTree:
+    """
+    Sum segment tree kept in a single array, the root at tree[1] and leaf i at
+    tree[size + i]. Updates and prefix sum searches walk the levels iteratively and
+    take whole batches of leaves at once.
+    """
+
     write = 0
 
     def __init__(self, capacity):
         self.capacity = capacity
-        self.tree = np.zeros(2 * capacity - 1)
+        self.size = 1 << max(capacity - 1, 0).bit_length()
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2 * self.size)
         self.data = np.zeros(capacity, dtype=object)
 
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
-
-        if parent != 0:
-            self._propagate(parent, change)
-
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self.tree[left])
-
     def total(self):
-        return self.tree[0]
+        return self.tree[1]
+
+    def update_leaves(self, indices, priorities):
+        """
+        :param indices: an array of leaf indices, for repeated ones the last priority is
+            kept
+        :param priorities: the new priorities of the leaves
+        """
+        idx = np.asarray(indices, dtype=np.int64) + self.size
+        if len(idx) == 0:
+            return
+        self.tree[idx] = priorities
+        idx = np.unique(idx // 2)
+        while idx[0] > 0:
+            self.tree[idx] = self.tree[2 * idx] + self.tree[2 * idx + 1]
+            idx = np.unique(idx // 2)
+
+    def find(self, values):
+        """
+        :param values: an array of prefix sums in [0, total())
+        :return: for every value the index of the leaf whose range contains it
+        """
+        values = np.array(values, dtype=np.float64)
+        idx = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * idx]
+            go_right = values > left
+            values -= np.where(go_right, left, 0.0)
+            idx = 2 * idx + go_right
+        return idx - self.size
 
     def add(self, p, data):
-        idx = self.write + self.capacity - 1
-
         self.data[self.write] = data
-        self.update(idx, p)
+        self.update(self.write, p)
 
         self.write += 1
         if self.write >= self.capacity:
             self.write = 0
 
     def update(self, idx, p):
-        change = p - self.tree[idx]
-
-        self.tree[idx] = p
-        self._propagate(idx, change)
+        self.update_leaves([idx], [p])
 
     def get(self, s):
-        idx = self._retrieve(0, s)
-        dataIdx = idx - self.capacity + 1
-
-        return (idx, self.tree[idx], self.data[dataIdx])
+        idx = min(self.find([s])[0], self.capacity - 1)
+        return (idx, self.tree[self.size + idx], self.data[idx])
 
 
 class NormalizedActions(gym.ActionWrapper):
@@ -0,0 +1,81 @@
+import queue
+import threading
+
+from parameters import Parameters
+
+
+class BatchPrefetcher:
+    """
+    Iterates over num_batches batches made by make_batch(i) in a background thread,
+    which keeps at most queue_size of them ready while the previous ones are used.
+    """
+
+    def __init__(self, make_batch, num_batches, queue_size=2):
+        self.make_batch = make_batch
+        self.num_batches = num_batches
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        for i in range(self.num_batches):
+            try:
+                batch = self.make_batch(i)
+            except Exception as e:
+                self.put(e)
+                return
+            if not self.put(batch):
+                return
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        try:
+            for _ in range(self.num_batches):
+                batch = self.queue.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def sample_batches(replay_buffer, iterations, batch_size, device, args: Parameters):
+    """
+    Draws iterations batches of tensors from a utils.ReplayBuffer
+    :param args: -bulk_sampling draws the indices of all the batches at once and
+        -prefetch prepares that many batches ahead in a background thread
+    :return: an iterable of (indices, batch), with batches as returned by
+        replay_buffer.sample_batch
+    """
+    if args.bulk_sampling:
+        all_ind = replay_buffer.sample_indices(batch_size, iterations)
+
+        def make_batch(i):
+            ind = all_ind[i * batch_size : (i + 1) * batch_size]
+            return ind, replay_buffer.get_batch_tensors(ind, device)
+
+    else:
+
+        def make_batch(i):
+            ind = replay_buffer.sample_indices(batch_size)
+            return ind, replay_buffer.get_batch_tensors(ind, device)
+
+    if args.prefetch > 0:
+        return BatchPrefetcher(make_batch, iterations, args.prefetch)
+    return (make_batch(i) for i in range(iterations))
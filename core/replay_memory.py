@@ -1,66 +1,84 @@
 import random
-import torch
+
 import numpy as np
-from collections import namedtuple
+import torch
 
-# Taken and adapted from
-# https://github.com/pytorch/tutorials/blob/master/Reinforcement%20(Q-)Learning%20with%20PyTorch.ipynb
+# Greater than every sequence number
+NO_SEQ = np.iinfo(np.int64).max
 
-Transition = namedtuple(
-    "Transition", ("state", "action", "next_state", "reward", "done")
-)
 
+class IndexReplayMemory(object):
+    """
+    Replay memory which keeps only the sequence numbers of transitions stored in a
+    shared store (utils.ReplayBuffer). Copying between memories copies the sequence
+    numbers and sampling is a single gather from the store. Transitions the store
+    has already overwritten are skipped.
 
-class ReplayMemory(object):
-    def __init__(self, capacity, device):
+    The number of live transitions is kept for the oldest sequence number of the
+    store seen so far (self.oldest) and counted again only when the store has
+    overwritten one of them since.
+    """
+
+    def __init__(self, capacity, device, store):
         self.device = device
         self.capacity = capacity
-        self.memory = []
+        self.store = store
+        self.seqs = np.zeros(capacity, dtype=np.int64)
         self.position = 0
-
-    def add(self, *args):
-        """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-
-        reshaped_args = []
-        for arg in args:
-            reshaped_args.append(np.reshape(arg, (1, -1)))
-
-        self.memory[self.position] = Transition(*reshaped_args)
+        self.size = 0
+        self.oldest = 0
+        self.num_live = 0
+        # A lower bound of the live sequence numbers
+        self.min_live = NO_SEQ
+
+    def add(self, seq):
+        """Saves the sequence number of a transition in the store."""
+        if self.size == self.capacity and self.seqs[self.position] >= self.oldest:
+            self.num_live -= 1
+        if seq >= self.oldest:
+            self.num_live += 1
+            self.min_live = min(self.min_live, seq)
+        self.seqs[self.position] = seq
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def extend(self, seqs):
+        seqs = seqs[-self.capacity :]
+        ind = (self.position + np.arange(len(seqs))) % self.capacity
+        # The free slots come first, from the position up to the capacity
+        num_replaced = max(self.size + len(seqs) - self.capacity, 0)
+        replaced = self.seqs[ind[len(seqs) - num_replaced :]]
+        self.num_live -= np.count_nonzero(replaced >= self.oldest)
+        live = seqs[seqs >= self.oldest]
+        if len(live):
+            self.num_live += len(live)
+            self.min_live = min(self.min_live, live.min())
+        self.seqs[ind] = seqs
+        self.position = (self.position + len(seqs)) % self.capacity
+        self.size = min(self.size + len(seqs), self.capacity)
 
     def add_content_of(self, other):
         """
         Adds the content of another replay buffer to this replay buffer
         :param other: another replay buffer
         """
-        latest_trans = other.get_latest(self.capacity)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.extend(other.get_latest(self.capacity))
 
     def get_latest(self, latest):
         """
-        Returns the latest element from the other buffer with the most recent ones at the end of the returned list
-        :param other: another replay buffer
+        Returns the sequence numbers of the latest live transitions with the most
+        recent ones at the end
         :param latest: the number of latest elements to return
-        :return: a list with the latest elements
+        :return: an array of sequence numbers
         """
-        if self.capacity < latest:
-            latest_trans = (
-                self.memory[self.position :].copy()
-                + self.memory[: self.position].copy()
-            )
-        elif len(self.memory) < self.capacity:
-            latest_trans = self.memory[-latest:].copy()
-        elif self.position >= latest:
-            latest_trans = self.memory[: self.position][-latest:].copy()
+        if self.size < self.capacity:
+            seqs = self.seqs[: self.size]
         else:
-            latest_trans = (
-                self.memory[-latest + self.position :].copy()
-                + self.memory[: self.position].copy()
+            seqs = np.concatenate(
+                [self.seqs[self.position :], self.seqs[: self.position]]
             )
-        return latest_trans
+        seqs = seqs[self.store.is_live(seqs)]
+        return seqs[max(len(seqs) - latest, 0) :]
 
     def add_latest_from(self, other, latest):
         """
@@ -68,103 +86,40 @@ class ReplayMemory(object):
         :param other: another replay buffer
         :param latest: the number of elements to add
         """
-        latest_trans = other.get_latest(latest)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.extend(other.get_latest(latest))
 
     def shuffle(self):
-        random.shuffle(self.memory)
+        np.random.shuffle(self.seqs[: self.size])
 
-    def sample(self, batch_size):
-        transitions = random.sample(self.memory, batch_size)
-        batch = Transition(*zip(*transitions))
+    def gather(self, seqs):
+        return tuple(
+            torch.as_tensor(field, dtype=torch.float32, device=self.device)
+            for field in self.store.get_transitions(seqs)
+        )
 
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+    def sample(self, batch_size):
+        return self.sample_from_latest(batch_size, self.capacity)
 
     def sample_from_latest(self, batch_size, latest):
-        latest_trans = self.get_latest(latest)
-        transitions = random.sample(latest_trans, batch_size)
-        batch = Transition(*zip(*transitions))
-
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+        seqs = self.get_latest(latest)
+        return self.gather(seqs[random.sample(range(len(seqs)), batch_size)])
 
     def __len__(self):
-        return len(self.memory)
+        oldest = self.store.oldest_seq()
+        if oldest > self.oldest:
+            self.oldest = oldest
+            if self.min_live < oldest:
+                self.count_live()
+        return self.num_live
+
+    def count_live(self):
+        live = self.seqs[: self.size]
+        live = live[live >= self.oldest]
+        self.num_live = len(live)
+        self.min_live = live.min() if len(live) else NO_SEQ
 
     def reset(self):
-        self.memory = []
         self.position = 0
-
-
-class PrioritizedReplayMemory(object):
-    def __init__(self, capacity, device, alpha=0.6, beta_start=0.4, beta_frames=100000):
-        self.prob_alpha = alpha
-        self.capacity = capacity
-        self.buffer = []
-        self.pos = 0
-        self.priorities = np.zeros((capacity,), dtype=np.float32)
-        self.frame = 1
-        self.beta_start = beta_start
-        self.beta_frames = beta_frames
-        self.device = device
-
-    def beta_by_frame(self, frame_idx):
-        return min(
-            1.0,
-            self.beta_start + frame_idx * (1.0 - self.beta_start) / self.beta_frames,
-        )
-
-    def push(self, transition: Transition):
-        max_prio = self.priorities.max() if self.buffer else 1.0**self.prob_alpha
-
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(transition)
-        else:
-            self.buffer[self.pos] = transition
-
-        self.priorities[self.pos] = max_prio
-
-        self.pos = (self.pos + 1) % self.capacity
-
-    def sample(self, batch_size):
-        if len(self.buffer) == self.capacity:
-            prios = self.priorities
-        else:
-            prios = self.priorities[: self.pos]
-
-        total = len(self.buffer)
-
-        probs = prios / prios.sum()
-
-        indices = np.random.choice(total, batch_size, p=probs)
-        samples = [self.buffer[idx] for idx in indices]
-
-        beta = self.beta_by_frame(self.frame)
-        self.frame += 1
-
-        # min of ALL probs, not just sampled probs
-        prob_min = probs.min()
-        max_weight = (prob_min * total) ** (-beta)
-
-        weights = (total * probs[indices]) ** (-beta)
-        weights /= max_weight
-        weights = torch.tensor(weights, device=self.device, dtype=torch.float)
-
-        return samples, indices, weights
-
-    def update_priorities(self, batch_indices, batch_priorities):
-        for idx, prio in zip(batch_indices, batch_priorities):
-            self.priorities[idx] = (prio + 1e-5) ** self.prob_alpha
-
-    def __len__(self):
-        return len(self.buffer)
+        self.size = 0
+        self.num_live = 0
+        self.min_live = NO_SEQ
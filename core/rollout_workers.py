@@ -0,0 +1,251 @@
+import atexit
+import copy
+import math
+import multiprocessing as mp
+import warnings
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+from core import ddpg
+from parameters import Parameters
+
+
+def run_episode(
+    env,
+    actor,
+    state_embedding,
+    args: Parameters,
+    seed,
+    is_action_noise=False,
+    store_transition=True,
+    PeVFA=None,
+):
+    """
+    Runs one episode the same way as Agent.evaluate, but instead of storing the
+    transitions it returns them with the episode
+    :param seed: seeds both the environment reset and the action noise
+    :param PeVFA: when given, the episode is cut after args.time_steps steps and
+        bootstrapped with the policy value network (use_n_step_return)
+    """
+    rng = np.random.default_rng(seed)
+    param = actor.flat
+    state = env.reset(seed=seed)[0]
+    done = False
+
+    total_reward = 0.0
+    n_step_discount_reward = 0.0
+    episode_timesteps = 0
+    state_list = []
+    reward_list = []
+    action_list = []
+    transitions = []
+
+    while not done:
+        action = actor.select_action(np.array(state), state_embedding)
+        if is_action_noise:
+            action = (action + rng.normal(0, 0.1, size=args.action_dim)).clip(-1.0, 1.0)
+        next_state, reward, terminated, truncated, info = env.step(action.flatten())
+        done = terminated or truncated
+        done_bool = 0 if episode_timesteps + 1 == 1000 else float(done)
+        total_reward += reward
+        n_step_discount_reward += math.pow(args.gamma, episode_timesteps) * reward
+        state_list.append(state)
+        reward_list.append(reward)
+        action_list.append(action.flatten())
+
+        next_action = None
+        if store_transition or PeVFA is not None:
+            next_action = actor.select_action(np.array(next_state), state_embedding)
+        if store_transition:
+            transitions.append(
+                (state, action, next_state, reward, done_bool, next_action)
+            )
+        episode_timesteps += 1
+        state = next_state
+
+        if PeVFA is not None and args.time_steps <= episode_timesteps:
+            input = torch.cat(
+                [
+                    torch.FloatTensor(np.array([next_state])),
+                    torch.FloatTensor(np.array([next_action])),
+                ],
+                -1,
+            )
+            with torch.no_grad():
+                next_Q1, next_Q2 = PeVFA.forward(input, param.unsqueeze(0))
+            next_state_Q = torch.min(next_Q1, next_Q2).numpy().flatten()
+            n_step_discount_reward += (
+                math.pow(args.gamma, episode_timesteps) * next_state_Q[0]
+            )
+            break
+
+    return {
+        "n_step_discount_reward": n_step_discount_reward,
+        "reward": total_reward,
+        "td_error": 0.0,
+        "state_list": state_list,
+        "reward_list": reward_list,
+        "action_list": action_list,
+        "transitions": transitions,
+    }
+
+
+def worker_loop(args, state_embedding, PeVFA, tasks, results):
+    torch.set_num_threads(1)
+    env = gym.make(args.env_name)
+    actor = ddpg.Actor(args)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        call, index, params, seed, is_action_noise, store_transition, use_pvn = task
+        try:
+            actor.load_flat(torch.from_numpy(params))
+            episode = run_episode(
+                env,
+                actor,
+                state_embedding,
+                args,
+                seed,
+                is_action_noise=is_action_noise,
+                store_transition=store_transition,
+                PeVFA=PeVFA if use_pvn else None,
+            )
+        except Exception as e:
+            results.put((call, index, e))
+        else:
+            results.put((call, index, episode))
+    env.close()
+
+
+class RolloutWorkerPool:
+    """
+    Persistent processes, each owning its own environment, which run whole episodes
+    for given actor weights.
+
+    The state embedding and the policy value network live in shared memory and are
+    refreshed before every batch of episodes, the actor weights are sent with each
+    episode. Episodes are pulled from a single queue, so a worker that finishes a
+    short episode immediately takes the next one, and results are handed back in
+    submission order to keep the replay buffer contents deterministic. Each result
+    is tagged with its call of run, so those of a call which raised or was not
+    exhausted are dropped by the next one.
+
+    Workers return whole episodes rather than streaming their transitions: the
+    transitions of an episode are stored after those of the episodes submitted
+    before it, so streamed ones would be held back in the same way.
+
+    Workers are forked, as spawning would re-run the entry script, and always run
+    on the CPU. A CUDA context does not survive the fork, so the pool refuses to
+    start when the device is cuda. The workers are stopped by close, which is also
+    called at exit.
+    """
+
+    def __init__(self, args: Parameters, num_workers):
+        if args.device.type == "cuda":
+            raise ValueError(
+                "-num_workers forks the process and cannot be used on cuda"
+            )
+        if args.render:
+            warnings.warn("-render is ignored by the episodes of -num_workers")
+        worker_args = copy.copy(args)
+        worker_args.device = torch.device("cpu")
+        self.args = worker_args
+
+        self.state_embedding = ddpg.shared_state_embedding(worker_args).share_memory()
+        self.PeVFA = ddpg.Policy_Value_Network(worker_args).share_memory()
+        self.num_episodes = 0
+        self.num_calls = 0
+
+        ctx = mp.get_context("fork")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [
+            ctx.Process(
+                target=worker_loop,
+                args=(
+                    worker_args,
+                    self.state_embedding,
+                    self.PeVFA,
+                    self.tasks,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def next_seed(self):
+        seed = (self.args.seed * 1000003 + self.num_episodes) % 2**31
+        self.num_episodes += 1
+        return seed
+
+    def run(
+        self,
+        all_params,
+        state_embedding,
+        is_action_noise=False,
+        store_transition=True,
+        PeVFA=None,
+    ):
+        """
+        Runs one episode for every row of all_params
+        :param all_params: flat actor parameters, one row per episode
+        :return: a generator of (row, episode) in the order of all_params
+        """
+        self.num_calls += 1
+        call = self.num_calls
+        ddpg.hard_update(self.state_embedding, state_embedding)
+        if PeVFA is not None:
+            ddpg.hard_update(self.PeVFA, PeVFA)
+
+        for index, params in enumerate(all_params):
+            self.tasks.put(
+                (
+                    call,
+                    index,
+                    np.asarray(params, dtype=np.float32),
+                    self.next_seed(),
+                    is_action_noise,
+                    store_transition,
+                    PeVFA is not None,
+                )
+            )
+
+        finished = {}
+        next_index = 0
+        while next_index < len(all_params):
+            result_call, index, episode = self.results.get()
+            if result_call != call:
+                continue
+            if isinstance(episode, Exception):
+                raise episode
+            finished[index] = episode
+            while next_index in finished:
+                yield next_index, finished.pop(next_index)
+                next_index += 1
+
+    def close(self, timeout=5.0):
+        """
+        Stops the workers, those still running an episode after timeout seconds are
+        terminated
+        """
+        if not self.workers:
+            return
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+        self.tasks.close()
+        self.results.close()
+        atexit.unregister(self.close)
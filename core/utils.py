@@ -1,5 +1,14 @@
+import hashlib
+import json
+import os
+import threading
+
 import numpy as np
 import scipy.signal
+import torch
+
+from core.mod_utils import SumTree
+
 # from mpi_tools import mpi_statistics_scalar
 
 
@@ -7,46 +16,498 @@ import scipy.signal
 # https://github.com/openai/baselines/blob/master/baselines/deepq/replay_buffer.py
 
 
-# Expects tuples of (state, next_state, action, reward, done)
+class PolicyVersionTable(object):
+    """
+    Stores every distinct flat policy parameter vector once, under an integer id.
+    Vectors are deduplicated by a hash of their contents and reference counted by the
+    transitions using them, the rows of unreferenced vectors are reused.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.params = None
+        self.refcounts = np.zeros(capacity, dtype=np.int64)
+        self.keys = [None] * capacity
+        self.ids = {}
+        self.free = []
+        self.num_rows = 0
+
+    def new_params(self, capacity, num_params):
+        return np.zeros((capacity, num_params), dtype=np.float32)
+
+    @staticmethod
+    def key(params):
+        return hashlib.blake2b(params.tobytes(), digest_size=16).digest()
+
+    def grow(self):
+        self.capacity *= 2
+        params = self.new_params(self.capacity, self.params.shape[1])
+        params[: self.num_rows] = self.params[: self.num_rows]
+        self.params = params
+        self.refcounts = np.concatenate([self.refcounts, np.zeros_like(self.refcounts)])
+        self.keys += [None] * (self.capacity - len(self.keys))
+
+    def add(self, params):
+        """
+        :param params: a flat policy parameter vector
+        :return: the id of the vector, the same for vectors with equal contents
+        """
+        params = np.asarray(params, dtype=np.float32).reshape(-1)
+        key = self.key(params)
+        if key in self.ids:
+            return self.ids[key]
+
+        if self.params is None:
+            self.params = self.new_params(self.capacity, len(params))
+        if self.free:
+            policy_id = self.free.pop()
+        else:
+            if self.num_rows == self.capacity:
+                self.grow()
+            policy_id = self.num_rows
+            self.num_rows += 1
+
+        self.params[policy_id] = params
+        self.keys[policy_id] = key
+        self.ids[key] = policy_id
+        return policy_id
+
+    def acquire(self, policy_id):
+        self.refcounts[policy_id] += 1
+
+    def release(self, policy_id):
+        self.refcounts[policy_id] -= 1
+        if self.refcounts[policy_id] == 0:
+            del self.ids[self.keys[policy_id]]
+            self.keys[policy_id] = None
+            self.free.append(policy_id)
+
+    def get(self, policy_ids):
+        """
+        :param policy_ids: an array of ids
+        :return: the vectors of the ids, one row per id
+        """
+        return self.params[policy_ids]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# Expects tuples of (state, next_state, action, reward, done, next_action, policy_id),
+# where policy_id is the id of the policy parameters in self.policy_versions
 class ReplayBuffer(object):
+    """
+    Ring buffer keeping every field of the transitions in its own preallocated float32
+    array, allocated on the first add from the shapes of the transition. Policy
+    parameters are kept once per version in a PolicyVersionTable and gathered when
+    sampled.
+
+    Every added transition gets a sequence number, which stays valid until the ring
+    overwrites the transition and is used by replay_memory.IndexReplayMemory to refer
+    to it.
+    """
+
+    fields = ("state", "next_state", "action", "reward", "done", "next_action")
+
     def __init__(self, max_size=1e6):
-        self.storage = []
-        self.max_size = max_size
+        self.max_size = int(max_size)
         self.ptr = 0
+        self.size = 0
+        self.num_added = 0
+        self.storage = None
+        self.policy_ids = self.new_array("policy_ids", (self.max_size,), np.int64)
+        self.policy_versions = PolicyVersionTable()
+
+    def new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def allocate(self, data):
+        self.storage = {
+            name: self.new_array(name, (self.max_size, *np.shape(value)), np.float32)
+            for name, value in zip(self.fields, data)
+        }
+
+    def write(self, ind, data):
+        for name, value in zip(self.fields, data):
+            self.storage[name][ind] = value
 
     def add(self, data):
-        if len(self.storage) == self.max_size:
-            self.storage[int(self.ptr)] = data
-            self.ptr = (self.ptr + 1) % self.max_size
-        else:
-            self.storage.append(data)
+        if self.storage is None:
+            self.allocate(data)
+        # Acquired before the overwritten id is released, which may be the same one
+        self.policy_versions.acquire(data[-1])
+        if self.size == self.max_size:
+            self.policy_versions.release(self.policy_ids[self.ptr])
+        self.write(self.ptr, data)
+        self.policy_ids[self.ptr] = data[-1]
+
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+        self.num_added += 1
+        return self.num_added - 1
+
+    def __len__(self):
+        return self.size
+
+    def sample_indices(self, batch_size, num_batches=1):
+        """:return: the indices of num_batches batches, one after the other"""
+        return np.random.randint(0, self.size, size=num_batches * batch_size)
+
+    def flush(self):
+        pass
+
+    def get_batch(self, ind, with_policy_params=True):
+        """
+        :param with_policy_params: when False, None is returned in place of the policy
+            parameters and they are not gathered
+        """
+        policy_params = None
+        if with_policy_params:
+            policy_params = self.policy_versions.get(self.policy_ids[ind])
+        return (
+            self.storage["state"][ind],
+            self.storage["next_state"][ind],
+            self.storage["action"][ind],
+            self.storage["reward"][ind].reshape(-1, 1),
+            self.storage["done"][ind].reshape(-1, 1),
+            policy_params,
+            self.storage["next_action"][ind],
+        )
 
-    def sample(self, batch_size):
-        ind = np.random.randint(0, len(self.storage), size=batch_size)
-        x, y, u, r, d, nu, parameters = [], [], [], [], [], [], []
-        # print(len(self.storage), "   ", ind)
+    def sample(self, batch_size, with_policy_params=True):
+        return self.get_batch(self.sample_indices(batch_size), with_policy_params)
 
-        # print(self.storage[ind[0]])
+    def get_batch_tensors(self, ind, device, with_policy_params=False):
+        """
+        Same as get_batch, but returns float tensors on device
+        """
+        return tuple(
+            None if field is None else torch.from_numpy(field).to(device)
+            for field in self.get_batch(ind, with_policy_params)
+        )
 
-        for i in ind:
-            X, Y, U, R, D, NU, P = self.storage[i]
-            x.append(np.asarray(X))
-            y.append(np.asarray(Y))
-            u.append(np.asarray(U))
-            r.append(np.asarray(R))
-            d.append(np.asarray(D))
-            nu.append(np.asarray(NU))
-            parameters.append(np.asarray(P))
+    def sample_batch(self, batch_size, device, with_policy_params=False):
+        return self.get_batch_tensors(
+            self.sample_indices(batch_size), device, with_policy_params
+        )
+
+    def oldest_seq(self):
+        """:return: the sequence number of the oldest transition not overwritten yet"""
+        return self.num_added - self.size
+
+    def is_live(self, seqs):
+        """
+        :param seqs: an array of sequence numbers returned by add
+        :return: a mask of the transitions which have not been overwritten yet
+        """
+        return seqs >= self.oldest_seq()
+
+    def get_transitions(self, seqs):
+        """
+        :param seqs: an array of sequence numbers of live transitions
+        :return: (state, action, next_state, reward, done), one row per transition
+        """
+        ind = seqs % self.max_size
+        return (
+            self.storage["state"][ind],
+            self.storage["action"][ind],
+            self.storage["next_state"][ind],
+            self.storage["reward"][ind].reshape(-1, 1),
+            self.storage["done"][ind].reshape(-1, 1),
+        )
+
+
+class TorchReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer keeping the transitions in preallocated tensors on device, so that
+    sample_batch indexes them with torch.randint and index_select without leaving
+    torch. sample and get_batch still return NumPy arrays.
+    """
+
+    def __init__(self, max_size=1e6, device="cpu"):
+        super().__init__(max_size)
+        self.device = device
+
+    def allocate(self, data):
+        self.storage = {
+            name: torch.zeros(
+                (self.max_size, *np.shape(value)),
+                dtype=torch.float32,
+                device=self.device,
+            )
+            for name, value in zip(self.fields, data)
+        }
+
+    def write(self, ind, data):
+        for name, value in zip(self.fields, data):
+            self.storage[name][ind] = torch.as_tensor(value, dtype=torch.float32)
+
+    def sample_indices(self, batch_size, num_batches=1):
+        return torch.randint(
+            0, self.size, (num_batches * batch_size,), device=self.device
+        )
+
+    def get_tensors(self, ind, with_policy_params):
+        ind = torch.as_tensor(ind, device=self.device)
+        policy_params = None
+        if with_policy_params:
+            policy_ids = self.policy_ids[ind.cpu().numpy()]
+            policy_params = torch.from_numpy(self.policy_versions.get(policy_ids))
         return (
-            np.array(x),
-            np.array(y),
-            np.array(u),
-            np.array(r).reshape(-1, 1),
-            np.array(d).reshape(-1, 1),
-            np.array(parameters),
-            np.array(nu),
+            self.storage["state"].index_select(0, ind),
+            self.storage["next_state"].index_select(0, ind),
+            self.storage["action"].index_select(0, ind),
+            self.storage["reward"].index_select(0, ind).view(-1, 1),
+            self.storage["done"].index_select(0, ind).view(-1, 1),
+            policy_params,
+            self.storage["next_action"].index_select(0, ind),
+        )
+
+    def get_batch(self, ind, with_policy_params=True):
+        return tuple(
+            None if field is None else field.cpu().numpy()
+            for field in self.get_tensors(ind, with_policy_params)
+        )
+
+    def get_batch_tensors(self, ind, device, with_policy_params=False):
+        return tuple(
+            None if field is None else field.to(device)
+            for field in self.get_tensors(ind, with_policy_params)
+        )
+
+    def get_transitions(self, seqs):
+        ind = torch.as_tensor(seqs % self.max_size, device=self.device)
+        return (
+            self.storage["state"].index_select(0, ind),
+            self.storage["action"].index_select(0, ind),
+            self.storage["next_state"].index_select(0, ind),
+            self.storage["reward"].index_select(0, ind).view(-1, 1),
+            self.storage["done"].index_select(0, ind).view(-1, 1),
+        )
+
+
+class MemmapPolicyVersionTable(PolicyVersionTable):
+    """
+    PolicyVersionTable keeping the parameter vectors in a np.memmap file in folder,
+    which is replaced by a file twice as large when the table grows.
+    """
+
+    def __init__(self, folder, capacity=64):
+        super().__init__(capacity)
+        self.folder = folder
+
+    def new_params(self, capacity, num_params):
+        return np.lib.format.open_memmap(
+            os.path.join(self.folder, f"policy_params_{capacity}.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(capacity, num_params),
         )
 
+    def grow(self):
+        old_filename = self.params.filename
+        super().grow()
+        os.remove(old_filename)
+
+    def state(self):
+        if self.params is None:
+            return None
+        self.params.flush()
+        return {
+            "filename": os.path.basename(self.params.filename),
+            "num_rows": self.num_rows,
+        }
+
+    def load(self, state, live_ids, mode):
+        """
+        Maps the parameter file written by a previous run and rebuilds the reference
+        counts and hashes from the ids of the live transitions
+        """
+        if state is None:
+            return
+        self.params = np.load(
+            os.path.join(self.folder, state["filename"]), mmap_mode=mode
+        )
+        self.capacity = len(self.params)
+        self.num_rows = state["num_rows"]
+        self.refcounts = np.bincount(live_ids, minlength=self.capacity)
+        self.keys = [None] * self.capacity
+        for policy_id in range(self.num_rows):
+            if self.refcounts[policy_id] > 0:
+                self.keys[policy_id] = self.key(np.asarray(self.params[policy_id]))
+                self.ids[self.keys[policy_id]] = policy_id
+            else:
+                self.free.append(policy_id)
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer whose arrays are np.memmap files in folder, which leaves it to the OS
+    page cache to decide which transitions stay in memory. flush writes the state of
+    the ring to meta.json, after which open maps the files again, read-only for
+    analysis or writable to continue a run.
+    """
+
+    def __init__(self, folder, max_size=1e6, mode="w+"):
+        self.folder = folder
+        self.mode = mode
+        meta = None
+        if mode == "w+":
+            os.makedirs(folder, exist_ok=True)
+        else:
+            with open(os.path.join(folder, "meta.json")) as f:
+                meta = json.load(f)
+            max_size = meta["max_size"]
+
+        super().__init__(max_size)
+        self.policy_versions = MemmapPolicyVersionTable(folder)
+        if meta is not None:
+            self.ptr = meta["ptr"]
+            self.size = meta["size"]
+            self.num_added = meta["num_added"]
+            if meta["allocated"]:
+                self.storage = {
+                    name: self.new_array(name, None, np.float32) for name in self.fields
+                }
+            self.policy_versions.load(
+                meta["policy_versions"], self.policy_ids[: self.size], mode
+            )
+
+    @classmethod
+    def open(cls, folder, writable=False):
+        return cls(folder, mode="r+" if writable else "r")
+
+    def new_array(self, name, shape, dtype):
+        filename = os.path.join(self.folder, name + ".npy")
+        if self.mode != "w+":
+            return np.load(filename, mmap_mode=self.mode)
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+    def flush(self):
+        if self.mode == "r":
+            return
+        self.policy_ids.flush()
+        if self.storage is not None:
+            for array in self.storage.values():
+                array.flush()
+        with open(os.path.join(self.folder, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "max_size": self.max_size,
+                    "ptr": self.ptr,
+                    "size": self.size,
+                    "num_added": self.num_added,
+                    "allocated": self.storage is not None,
+                    "policy_versions": self.policy_versions.state(),
+                },
+                f,
+            )
+
+
+class PrioritizedReplay:
+    """
+    Mixin for the ReplayBuffer classes which samples transitions proportionally to
+    priority ** alpha from a SumTree and corrects the bias with importance sampling
+    weights, with beta annealed from beta_zero to 1 over total_steps added
+    transitions. New transitions get the largest priority seen so far.
+
+    The tree is only read and written under tree_lock, as -prefetch samples the
+    batches in a background thread while the priorities are updated by training.
+    """
+
+    # Added to the absolute TD errors, and the floor of the priorities used for the
+    # importance sampling weights
+    min_priority = 1e-6
+
+    def init_priorities(self, alpha, beta_zero, total_steps):
+        self.alpha = alpha
+        self.beta_zero = beta_zero
+        self.total_steps = total_steps
+        self.max_priority = 1.0
+        self.tree = SumTree(self.max_size)
+        self.tree_lock = threading.Lock()
+        self.tree.update_leaves(np.arange(self.size), np.ones(self.size))
+
+    def add(self, data):
+        ind = self.ptr
+        seq = super().add(data)
+        with self.tree_lock:
+            self.tree.update_leaves([ind], [self.max_priority**self.alpha])
+        return seq
+
+    def sample_indices(self, batch_size, num_batches=1):
+        # Every batch takes one draw from each of batch_size equal segments of the
+        # total priority
+        values = np.arange(batch_size) + np.random.uniform(
+            size=(num_batches, batch_size)
+        )
+        with self.tree_lock:
+            segment = self.tree.total() / batch_size
+            ind = self.tree.find(values.reshape(-1) * segment)
+        return np.minimum(ind, self.size - 1)
+
+    def beta(self):
+        return self.beta_zero + (1.0 - self.beta_zero) * min(
+            1.0, self.num_added / self.total_steps
+        )
+
+    def importance_weights(self, ind):
+        """
+        :return: the importance sampling weights of the transitions, normalised by
+            their maximum
+        """
+        ind = np.asarray(ind)
+        with self.tree_lock:
+            priorities = self.tree.tree[self.tree.size + ind]
+            total = self.tree.total()
+        # A leaf sampled with zero priority, through the drift of total() or the
+        # clamp to the last transition, would get an infinite weight
+        probs = np.maximum(priorities, self.min_priority**self.alpha) / total
+        weights = (self.size * probs) ** -self.beta()
+        return weights / weights.max()
+
+    def update_priorities(self, ind, td_errors):
+        priorities = np.abs(np.asarray(td_errors).reshape(-1)) + self.min_priority
+        with self.tree_lock:
+            self.max_priority = max(self.max_priority, priorities.max())
+            self.tree.update_leaves(np.asarray(ind), priorities**self.alpha)
+
+
+class PrioritizedReplayBuffer(PrioritizedReplay, ReplayBuffer):
+    pass
+
+
+class PrioritizedTorchReplayBuffer(PrioritizedReplay, TorchReplayBuffer):
+    pass
+
+
+class PrioritizedMemmapReplayBuffer(PrioritizedReplay, MemmapReplayBuffer):
+    pass
+
+
+def make_replay_buffer(args):
+    """
+    :return: the global replay buffer for the backend selected by -replay_backend,
+        prioritized when -per is set
+    """
+    if args.replay_backend == "torch":
+        cls = PrioritizedTorchReplayBuffer if args.per else TorchReplayBuffer
+        replay_buffer = cls(args.buffer_size, args.device)
+    elif args.replay_backend == "memmap":
+        cls = PrioritizedMemmapReplayBuffer if args.per else MemmapReplayBuffer
+        folder = os.path.join(args.save_foldername, "replay")
+        if args.resume_replay:
+            replay_buffer = cls.open(folder, writable=True)
+        else:
+            replay_buffer = cls(folder, args.buffer_size)
+    else:
+        cls = PrioritizedReplayBuffer if args.per else ReplayBuffer
+        replay_buffer = cls(args.buffer_size)
+
+    if args.per:
+        replay_buffer.init_priorities(args.alpha, args.beta_zero, args.total_steps)
+    return replay_buffer
+
 
 def combined_shape(length, shape=None):
     if shape is None:
@@ -50,7 +50,24 @@ class Parameters:
         self.frac_frames_train = 1.0
         self.use_done_mask = True
         self.buffer_size = 1000000
+        # Storage of the global replay buffer: numpy arrays, torch tensors on device or
+        # memory-mapped files in save_foldername/replay
+        self.replay_backend = cla.replay_backend
+        # Continue with the memmap replay buffer left in save_foldername by a previous run
+        self.resume_replay = cla.resume_replay
+        # Batches prepared ahead by a background thread (0 disables) and drawing the
+        # indices of all the gradient steps of a TD3.train call at once
+        self.prefetch = cla.prefetch
+        self.bulk_sampling = cla.bulk_sampling
         self.ls = 300
+        # torch.compile the networks trained by TD3
+        self.compile = cla.compile
+        # Networks run under bfloat16 autocast by TD3.train (embedding, critic, pvn)
+        self.bf16 = cla.bf16
+
+        # Asynchronous TD3 learner and its gradient steps per collected frame
+        self.async_learner = cla.async_learner
+        self.utd_ratio = self.frac_frames_train if cla.utd_ratio is None else cla.utd_ratio
 
         # Prioritised Experience Replay
         self.per = cla.per
@@ -67,6 +84,11 @@ class Parameters:
         if cla.num_evals is not None:
             self.num_evals = cla.num_evals
 
+        # Evaluate the population in lockstep, one environment per genome
+        self.vec_eval = cla.vec_eval
+        # Run population and validation episodes on worker processes (0 disables)
+        self.num_workers = cla.num_workers
+
         # Elitism Rate
         self.elite_fraction = 0.2
         # Number of actors in the population
@@ -48,6 +48,54 @@ parser.add_argument("-detach_z", help="detach_z", action="store_true")
 parser.add_argument("-random_choose", help="Use random_choose", action="store_true")
 
 parser.add_argument("-per", help="Use Prioritised Experience Replay", action="store_true")
+parser.add_argument(
+    "-replay_backend",
+    help="Storage of the replay buffer. Choices: (numpy) (torch) (memmap), torch keeps it on the training device, "
+    "memmap in files under the log folder",
+    type=str,
+    choices=["numpy", "torch", "memmap"],
+    default="numpy",
+)
+parser.add_argument(
+    "-resume_replay",
+    help="Reopen the memmap replay buffer of a previous run with the same log folder",
+    action="store_true",
+)
+parser.add_argument(
+    "-prefetch",
+    help="Number of batches prepared ahead by a background thread for TD3 (0 disables). With -per the batches are "
+    "drawn from priorities up to that many gradient steps old",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "-bulk_sampling",
+    help="Draw the replay indices of all the TD3 gradient steps of a generation at once. With -per they are all "
+    "drawn from the priorities at the start of the generation",
+    action="store_true",
+)
+parser.add_argument(
+    "-async_learner",
+    help="Train TD3 in a background thread while the environments are stepped",
+    action="store_true",
+)
+parser.add_argument(
+    "-utd_ratio",
+    help="Gradient steps per collected frame for -async_learner (defaults to frac_frames_train)",
+    type=float,
+)
+parser.add_argument(
+    "-compile",
+    help="Run the TD3 networks with torch.compile, falling back to eager mode where it is unavailable",
+    action="store_true",
+)
+parser.add_argument(
+    "-bf16",
+    help="Networks trained by TD3 under bfloat16 autocast, with float32 weights. Choices: (embedding) (critic) (pvn)",
+    nargs="*",
+    choices=["embedding", "critic", "pvn"],
+    default=[],
+)
 parser.add_argument("-use_all", help="Use all", action="store_true")
 
 parser.add_argument("-intention", help="intention", action="store_true")
@@ -85,6 +133,17 @@ parser.add_argument(
 parser.add_argument("-K", help="K", type=int, default=5)
 parser.add_argument("-OFF_TYPE", help="OFF_TYPE", type=int, default=1)
 parser.add_argument("-num_evals", help="num_evals", type=int, default=1)
+parser.add_argument(
+    "-vec_eval",
+    help="Evaluate the population in lockstep with one batched forward pass per timestep",
+    action="store_true",
+)
+parser.add_argument(
+    "-num_workers",
+    help="Number of rollout worker processes for population and validation episodes (0 disables)",
+    type=int,
+    default=0,
+)
 
 parser.add_argument("-version", help="version", type=int, default=1)
 parser.add_argument("-time_steps", help="time_steps", type=int, default=1)
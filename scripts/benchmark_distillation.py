@@ -0,0 +1,156 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import ddpg, utils  # noqa: E402
+from core.mod_neuro_evo import SSNE  # noqa: E402
+from parameters import Parameters  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measures the time of the distillation crossover and the distance sorting of a generation."
+    )
+    parser.add_argument("--state-dim", type=int, help="Dimension of the synthetic states.", default=17)
+    parser.add_argument("--action-dim", type=int, help="Dimension of the actions.", default=6)
+    parser.add_argument("--children", type=int, help="Number of children distilled in a generation.", default=4)
+    parser.add_argument("--individual-bs", type=int, help="Size of the buffers of the genes.", default=8000)
+    parser.add_argument("--repeats", type=int, help="Distillations of the generation per method.", default=1)
+    parser.add_argument("--seed", type=int, help="Random seed.", default=1)
+    return parser.parse_args()
+
+
+def make_parameters(args: argparse.Namespace, save_foldername: str) -> Parameters:
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.state_dim = args.state_dim
+    parameters.action_dim = args.action_dim
+    parameters.use_ln = True
+    parameters.pop_size = 3 * args.children
+    parameters.ls = 300
+    parameters.individual_bs = args.individual_bs
+    parameters.elite_fraction = 0.2
+    parameters.prefetch = 0
+    parameters.opstat = False
+    parameters.opstat_freq = 1
+    parameters.save_foldername = save_foldername
+    return parameters
+
+
+def legacy_distilation_crossover(ssne: SSNE, gene1: ddpg.GeneticAgent, gene2: ddpg.GeneticAgent):
+    """The training loop of SSNE.distilation_crossover before the children were distilled together"""
+    new_agent = ddpg.GeneticAgent(ssne.args, gene1.buffer.store)
+    new_agent.buffer.add_latest_from(gene1.buffer, ssne.args.individual_bs // 2)
+    new_agent.buffer.add_latest_from(gene2.buffer, ssne.args.individual_bs // 2)
+    new_agent.buffer.shuffle()
+
+    ddpg.hard_update(new_agent.actor, gene2.actor)
+    batch_size = min(128, len(new_agent.buffer))
+    iters = len(new_agent.buffer) // batch_size if batch_size > 0 else 0
+    losses = []
+    for _ in range(12 * iters):
+        batch = new_agent.buffer.sample(batch_size)
+        losses.append(new_agent.update_parameters(batch, gene1.actor, gene2.actor, ssne.critic, ssne.state_embedding))
+    return new_agent, losses
+
+
+def legacy_sort_groups_by_distance(genomes, pop, state_embedding):
+    """SSNE.sort_groups_by_distance before the distance matrix, two fresh samples and forwards per pair"""
+
+    def get_distance(gene1: ddpg.GeneticAgent, gene2: ddpg.GeneticAgent):
+        batch_size = min(256, min(len(gene1.buffer), len(gene2.buffer)))
+        batch_gene1 = gene1.buffer.sample_from_latest(batch_size, 1000)
+        batch_gene2 = gene2.buffer.sample_from_latest(batch_size, 1000)
+        return gene1.actor.get_novelty(batch_gene2, state_embedding) + gene2.actor.get_novelty(
+            batch_gene1, state_embedding
+        )
+
+    groups = []
+    for i, first in enumerate(genomes):
+        for second in genomes[i + 1 :]:
+            groups.append((second, first, get_distance(pop[first], pop[second])))
+    return sorted(groups, key=lambda group: group[2], reverse=True)
+
+
+def time_sorting(name: str, sort, repeats: int):
+    """Reports the time of sorting the pairs of genomes by distance"""
+    sort()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        sort()
+    print(f"{name}: {1000 * (time.perf_counter() - start) / repeats:.3f} ms/generation")
+
+
+def run(name: str, distil, pairs, repeats: int):
+    """
+    Distills the children of the pairs and reports the time per child and the mean MSE of the last epoch
+    """
+    elapsed = 0.0
+    final_losses = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        losses = distil(pairs)
+        elapsed += time.perf_counter() - start
+        final_losses.append(np.mean(losses[-len(losses) // 12 :]))
+    print(f"{name}: {elapsed / (repeats * len(pairs)):.3f} s/child, MSE of the last epoch {np.mean(final_losses):.5f}")
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as save_foldername:
+        parameters = make_parameters(args, save_foldername)
+        store = utils.ReplayBuffer(parameters.pop_size * args.individual_bs)
+        population = ddpg.PopulationTensor(parameters, parameters.pop_size)
+        genes = [ddpg.GeneticAgent(parameters, store, population, i) for i in range(parameters.pop_size)]
+        parents, children = genes[: 2 * args.children], genes[2 * args.children :]
+        # Full buffers of random transitions, as the genes have after a few generations
+        policy_id = store.policy_versions.add(genes[0].actor.extract_parameters().numpy())
+        for gene in parents:
+            for _ in range(args.individual_bs):
+                state = np.random.randn(args.state_dim)
+                action = np.random.uniform(-1, 1, args.action_dim)
+                gene.buffer.add(store.add((state, state, action, np.zeros(1), np.zeros(1), action, policy_id)))
+        state_embedding = ddpg.shared_state_embedding(parameters)
+        critic = ddpg.Critic(parameters)
+        ssne = SSNE(parameters, critic, None, state_embedding, 0.05, 0.1)
+        pairs = list(zip(parents[0::2], parents[1::2]))
+
+        def legacy(pairs):
+            losses = [legacy_distilation_crossover(ssne, gene1, gene2)[1] for gene1, gene2 in pairs]
+            return np.mean(losses, axis=0)
+
+        def batched(pairs):
+            losses = ssne.distilation_crossover_population(pairs, children)
+            return losses.mean(axis=1)
+
+        run("legacy per child", legacy, pairs, args.repeats)
+        run("distilation_crossover_population", batched, pairs, args.repeats)
+
+        genomes = list(range(len(parents)))
+
+        def sort_by_distance():
+            ssne.draw_probe_states(parents)
+            return ssne.sort_groups_by_distance(genomes, parents)
+
+        time_sorting(
+            "legacy sort_groups_by_distance",
+            lambda: legacy_sort_groups_by_distance(genomes, parents, state_embedding),
+            20,
+        )
+        time_sorting("sort_groups_by_distance", sort_by_distance, 20)
+
+
+if __name__ == "__main__":
+    main()
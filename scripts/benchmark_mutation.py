@@ -0,0 +1,169 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import ddpg, utils  # noqa: E402
+from core.mod_neuro_evo import SSNE  # noqa: E402
+from parameters import Parameters  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measures the time of the SSNE mutations of a population.")
+    parser.add_argument("--state-dim", type=int, help="Dimension of the synthetic states.", default=17)
+    parser.add_argument("--action-dim", type=int, help="Dimension of the actions.", default=6)
+    parser.add_argument("--pop-size", type=int, help="Number of actors in the population.", default=10)
+    parser.add_argument("--prob-reset-and-sup", type=float, help="prob_reset_and_sup of SSNE.", default=0.05)
+    parser.add_argument("--frac", type=float, help="frac of SSNE.", default=0.1)
+    parser.add_argument("--mutation-mag", type=float, help="Magnitude of the proximal mutation.", default=0.05)
+    parser.add_argument("--repeats", type=int, help="Mutations of the population per method.", default=20)
+    parser.add_argument("--seed", type=int, help="Random seed.", default=1)
+    return parser.parse_args()
+
+
+def make_parameters(args: argparse.Namespace, save_foldername: str) -> Parameters:
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.state_dim = args.state_dim
+    parameters.action_dim = args.action_dim
+    parameters.use_ln = True
+    parameters.mutation_batch_size = 256
+    parameters.mutation_mag = args.mutation_mag
+    parameters.mutation_noise = False
+    parameters.pop_size = args.pop_size
+    parameters.ls = 300
+    parameters.individual_bs = 8000
+    parameters.elite_fraction = 0.2
+    parameters.opstat = False
+    parameters.opstat_freq = 1
+    parameters.save_foldername = save_foldername
+    return parameters
+
+
+def legacy_mutate(ssne: SSNE, weight: torch.Tensor):
+    """The element by element mutation of SSNE.mutate_inplace before it was vectorized"""
+    mut_strength = 0.1
+    super_mut_strength = 10
+    super_mut_prob = ssne.prob_reset_and_sup
+    reset_prob = super_mut_prob + ssne.prob_reset_and_sup
+
+    if random.random() < np.random.uniform(0, 1) * 2:
+        for index in range(weight.shape[0]):
+            index_list = random.sample(range(weight.shape[1]), int(weight.shape[1] * ssne.frac))
+            random_num = random.random()
+            if random_num < super_mut_prob:
+                for ind in index_list:
+                    weight[index, ind] += random.gauss(0, super_mut_strength * weight[index, ind])
+            elif random_num < reset_prob:
+                for ind in index_list:
+                    weight[index, ind] = random.gauss(0, 1)
+            else:
+                for ind in index_list:
+                    weight[index, ind] += random.gauss(0, mut_strength * weight[index, ind])
+            weight[index, :] = np.clip(weight[index, :], a_min=-1000000, a_max=1000000)
+
+
+def legacy_proximal_mutate(ssne: SSNE, gene: ddpg.GeneticAgent, mag: float):
+    """The safe mutation of SSNE.proximal_mutate before it used torch.func, one backward pass per action"""
+    model = gene.actor
+    state, _, _, _, _ = gene.buffer.sample(min(ssne.args.mutation_batch_size, len(gene.buffer)))
+    output = model(state, ssne.state_embedding)
+    params = model.extract_parameters()
+    delta = torch.randn_like(params) * mag
+
+    jacobian = torch.zeros(output.size()[1], model.count_parameters())
+    grad_output = torch.zeros(output.size())
+    for i in range(output.size()[1]):
+        model.zero_grad()
+        grad_output.zero_()
+        grad_output[:, i] = 1.0
+        output.backward(grad_output, retain_graph=True)
+        jacobian[i] = model.extract_grad()
+
+    scaling = torch.sqrt((jacobian**2).sum(0))
+    scaling[scaling == 0] = 1.0
+    scaling[scaling < 0.01] = 0.01
+    model.inject_parameters(params + delta / scaling)
+
+
+def run(name: str, mutate, genes, repeats: int):
+    """
+    Mutates copies of the genes and reports the time per gene and the fraction of weights which were changed
+    """
+    initial = [gene.actor.extract_parameters() for gene in genes]
+    # Warmup, the first calls can include lazy imports and allocations
+    mutate(genes)
+    elapsed = 0.0
+    changed = []
+    for _ in range(repeats):
+        for gene, params in zip(genes, initial):
+            gene.actor.inject_parameters(params)
+        start = time.perf_counter()
+        mutate(genes)
+        elapsed += time.perf_counter() - start
+        changed += [
+            (gene.actor.extract_parameters() != params).float().mean().item() for gene, params in zip(genes, initial)
+        ]
+    print(
+        f"{name}: {1000 * elapsed / (repeats * len(genes)):.3f} ms/gene,"
+        f" fraction of changed weights {np.mean(changed):.4f}"
+    )
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as save_foldername:
+        parameters = make_parameters(args, save_foldername)
+        store = utils.ReplayBuffer(1000)
+        population = ddpg.PopulationTensor(parameters, args.pop_size)
+        genes = [ddpg.GeneticAgent(parameters, store, population, i) for i in range(args.pop_size)]
+        # Transitions of random states for the proximal mutation
+        policy_id = store.policy_versions.add(genes[0].actor.extract_parameters().numpy())
+        for i in range(1000):
+            state = np.random.randn(args.state_dim)
+            action = np.random.uniform(-1, 1, args.action_dim)
+            genes[i % len(genes)].buffer.add(
+                store.add((state, state, action, np.zeros(1), np.zeros(1), action, policy_id))
+            )
+        state_embedding = ddpg.shared_state_embedding(parameters)
+        ssne = SSNE(parameters, None, None, state_embedding, args.prob_reset_and_sup, args.frac)
+
+        def legacy(genes):
+            with torch.no_grad():
+                for gene in genes:
+                    legacy_mutate(ssne, gene.actor.w_out.weight)
+
+        def per_gene(genes):
+            for gene in genes:
+                ssne.mutate_inplace(gene)
+
+        run("legacy loop", legacy, genes, args.repeats)
+        run("mutate_inplace", per_gene, genes, args.repeats)
+        run("mutate_population", ssne.mutate_population, genes, args.repeats)
+
+        def legacy_proximal(genes):
+            for gene in genes:
+                legacy_proximal_mutate(ssne, gene, args.mutation_mag)
+
+        run("legacy proximal_mutate", legacy_proximal, genes, args.repeats)
+        run(
+            "proximal_mutate_population",
+            lambda genes: ssne.proximal_mutate_population(genes, args.mutation_mag),
+            genes,
+            args.repeats,
+        )
+
+
+if __name__ == "__main__":
+    main()
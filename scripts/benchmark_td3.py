@@ -0,0 +1,153 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import ddpg, utils  # noqa: E402
+from parameters import Parameters  # noqa: E402
+
+# Overrides of the parameters in every benchmarked mode
+MODES = {
+    "eager": {},
+    "compile": {"compile": True},
+    "bf16": {"bf16": ["embedding", "critic", "pvn"]},
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measures the gradient steps per second of TD3.train.")
+    parser.add_argument("--state-dim", type=int, help="Dimension of the synthetic states.", default=17)
+    parser.add_argument("--action-dim", type=int, help="Dimension of the synthetic actions.", default=6)
+    parser.add_argument("--pop-size", type=int, help="Number of actors in the population.", default=10)
+    parser.add_argument("--batch-size", type=int, help="Batch size of the gradient steps.", default=128)
+    parser.add_argument("--steps", type=int, help="Measured gradient steps per mode.", default=500)
+    parser.add_argument("--warmup", type=int, help="Gradient steps run before measuring.", default=50)
+    parser.add_argument("--buffer-size", type=int, help="Number of synthetic transitions.", default=100000)
+    parser.add_argument("--disable-cuda", help="Benchmark on the CPU.", action="store_true")
+    parser.add_argument("--seed", type=int, help="Random seed.", default=1)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=list(MODES.keys()),
+        help="Modes to benchmark, compared to the first one.",
+        default=list(MODES.keys()),
+    )
+    return parser.parse_args()
+
+
+def make_parameters(args: argparse.Namespace, mode: str) -> Parameters:
+    parameters = Parameters(None, init=False)
+    if not args.disable_cuda and torch.cuda.is_available():
+        parameters.device = torch.device("cuda")
+    else:
+        parameters.device = torch.device("cpu")
+    parameters.state_dim = args.state_dim
+    parameters.action_dim = args.action_dim
+    parameters.pop_size = args.pop_size
+    parameters.buffer_size = args.buffer_size
+
+    # The defaults of Parameters and run_re2.py
+    parameters.use_ln = True
+    parameters.ls = 300
+    parameters.pr = 128
+    parameters.K = 5
+    parameters.OFF_TYPE = 1
+    parameters.EA = True
+    parameters.use_all = False
+    parameters.actor_alpha = 1.0
+    parameters.EA_actor_alpha = 1.0
+    parameters.individual_bs = 8000
+    parameters.per = False
+    parameters.replay_backend = "numpy"
+    parameters.prefetch = 0
+    parameters.bulk_sampling = False
+    parameters.compile = False
+    parameters.bf16 = []
+    for key, value in MODES[mode].items():
+        setattr(parameters, key, value)
+    return parameters
+
+
+def fill_replay_buffer(parameters: Parameters, num_policies: int = 16) -> utils.ReplayBuffer:
+    replay_buffer = utils.ReplayBuffer(parameters.buffer_size)
+    policy_size = parameters.ls * parameters.action_dim + parameters.action_dim
+    policy_ids = [replay_buffer.policy_versions.add(np.random.randn(policy_size)) for _ in range(num_policies)]
+    for i in range(parameters.buffer_size):
+        replay_buffer.add(
+            (
+                np.random.randn(parameters.state_dim),
+                np.random.randn(parameters.state_dim),
+                np.random.uniform(-1, 1, parameters.action_dim),
+                np.random.randn(1),
+                np.zeros(1),
+                np.random.uniform(-1, 1, parameters.action_dim),
+                policy_ids[i % num_policies],
+            )
+        )
+    return replay_buffer
+
+
+def train(agent: ddpg.TD3, actor_bank: ddpg.ActorBank, replay_buffer, iterations: int, batch_size: int) -> float:
+    _, critic_loss, _, _, _ = agent.train(
+        evo_times=1,
+        all_fitness=None,
+        all_gen=None,
+        on_policy_states=None,
+        on_policy_params=None,
+        on_policy_discount_rewards=None,
+        on_policy_actions=None,
+        replay_buffer=replay_buffer,
+        iterations=iterations,
+        batch_size=batch_size,
+        all_actor=actor_bank,
+    )
+    return critic_loss
+
+
+def benchmark(args: argparse.Namespace, mode: str, replay_buffer) -> tuple[float, float]:
+    """
+    :return: the gradient steps per second and the mean critic loss of the measured steps
+    """
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    parameters = make_parameters(args, mode)
+    population = ddpg.PopulationTensor(parameters, parameters.pop_size + 1)
+    agent = ddpg.TD3(parameters, replay_buffer, population, parameters.pop_size)
+    actors = [ddpg.Actor(parameters, population=population, index=i) for i in range(parameters.pop_size)]
+    actor_bank = ddpg.ActorBank(actors + [agent.actor], population.params)
+
+    train(agent, actor_bank, replay_buffer, args.warmup, args.batch_size)
+    if parameters.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    critic_loss = train(agent, actor_bank, replay_buffer, args.steps, args.batch_size)
+    if parameters.device.type == "cuda":
+        torch.cuda.synchronize()
+    return args.steps / (time.perf_counter() - start), critic_loss
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    replay_buffer = fill_replay_buffer(make_parameters(args, "eager"))
+
+    baseline = None
+    for mode in args.modes:
+        steps_per_second, critic_loss = benchmark(args, mode, replay_buffer)
+        if baseline is None:
+            baseline = steps_per_second
+        print(
+            f"{mode}: {steps_per_second:.1f} gradient steps/s ({steps_per_second / baseline:.2f}x),"
+            f" critic loss {critic_loss:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+
+from core import ddpg, utils
+from core.mod_neuro_evo import SSNE
+from parameters import Parameters
+
+
+def make_parameters(save_foldername):
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.state_dim = 5
+    parameters.action_dim = 3
+    parameters.ls = 300
+    parameters.use_ln = True
+    parameters.pop_size = 6
+    parameters.individual_bs = 128
+    parameters.elite_fraction = 0.2
+    parameters.opstat = False
+    parameters.save_foldername = str(save_foldername)
+    return parameters
+
+
+def make_genes(parameters, sizes):
+    """:return: the genes of a population, the first ones with sizes random transitions"""
+    store = utils.ReplayBuffer(1000)
+    population = ddpg.PopulationTensor(parameters, parameters.pop_size)
+    genes = [ddpg.GeneticAgent(parameters, store, population, i) for i in range(parameters.pop_size)]
+    policy_id = store.policy_versions.add(np.zeros(1))
+    for gene, size in zip(genes, sizes):
+        for _ in range(size):
+            state = np.random.randn(parameters.state_dim)
+            action = np.random.uniform(-1, 1, parameters.action_dim)
+            gene.buffer.add(store.add((state, state, action, np.zeros(1), np.zeros(1), action, policy_id)))
+    return genes
+
+
+def make_ssne(parameters):
+    return SSNE(parameters, ddpg.Critic(parameters), None, ddpg.shared_state_embedding(parameters), 0.05, 0.1)
+
+
+def test_batched_distillation_matches_update_parameters(tmp_path):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    parameters = make_parameters(tmp_path)
+    # The children get 128 and 80 transitions, a single batch of their whole buffer
+    genes = make_genes(parameters, (64, 64, 40, 40))
+    store = genes[0].buffer.store
+    ssne = make_ssne(parameters)
+    pairs = [(genes[0], genes[1]), (genes[2], genes[3])]
+    children = genes[4:]
+
+    references = []
+    for gene1, gene2 in pairs:
+        reference = ddpg.GeneticAgent(parameters, store)
+        reference.population.set_rows([0], gene2.population.get_rows([gene2.index]))
+        references.append(reference)
+    losses = ssne.distilation_crossover_population(pairs, children)
+
+    assert losses.shape == (12, 2)
+    for i, ((gene1, gene2), child, reference) in enumerate(zip(pairs, children, references)):
+        seqs = child.buffer.get_latest(child.buffer.capacity)
+        reference.buffer.extend(seqs)
+        expected = [
+            reference.update_parameters(
+                reference.buffer.sample(len(seqs)), gene1.actor, gene2.actor, ssne.critic, ssne.state_embedding
+            )
+            for _ in range(12)
+        ]
+        np.testing.assert_allclose(losses[:, i], expected, rtol=1e-4)
+        torch.testing.assert_close(child.flat, reference.flat, rtol=1e-4, atol=1e-6)
+
+
+def test_distance_matrix_matches_the_pairwise_distances(tmp_path):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    parameters = make_parameters(tmp_path)
+    genes = make_genes(parameters, (100,) * parameters.pop_size)
+    ssne = make_ssne(parameters)
+    ssne.draw_probe_states(genes)
+
+    genomes = [0, 2, 3, 5]
+    distances = ssne.distance_matrix([genes[i] for i in genomes])
+    with torch.no_grad():
+        actions = [genes[i].actor.select_action_from_z(ssne.probe_s_z) for i in genomes]
+    for i in range(len(genomes)):
+        for j in range(len(genomes)):
+            expected = ((actions[i] - actions[j]) ** 2).sum(-1).mean()
+            torch.testing.assert_close(distances[i, j], expected)
+
+    groups = ssne.sort_groups_by_distance(genomes, genes)
+    assert len(groups) == 6
+    assert [group[2] for group in groups] == sorted((group[2] for group in groups), reverse=True)
+    for second, first, distance in groups:
+        assert distance == distances[genomes.index(first), genomes.index(second)].item()
@@ -0,0 +1,83 @@
+import torch
+from torch.nn import functional as F
+
+from core import ddpg
+from parameters import Parameters
+
+# The separate layers of the two twin networks in the state dicts saved before the
+# ensembles, in the order they are applied
+CRITIC_LAYERS = (
+    ("w_l1", "lnorm1", "w_l2", "lnorm2", "w_out"),
+    ("w_l3", "lnorm3", "w_l4", "lnorm4", "w_out_2"),
+)
+PVN_POLICY_LAYERS = (("policy_w_l1", "policy_w_l2", "policy_w_l3"), ("policy_w_l4", "policy_w_l5", "policy_w_l6"))
+
+
+def make_parameters():
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.state_dim = 5
+    parameters.action_dim = 3
+    parameters.ls = 300
+    parameters.pr = 64
+    parameters.use_ln = True
+    parameters.OFF_TYPE = 1
+    return parameters
+
+
+def legacy_state_dict(module, twins):
+    """Random weights for the separate layers of the twins, shaped as the ensemble layers"""
+    state_dict = {}
+    for key, value in module.state_dict().items():
+        name, field = key.rsplit(".", 1)
+        for member, layers in enumerate(twins):
+            legacy = dict(zip(twins[0], layers))[name]
+            state_dict[f"{legacy}.{field}"] = torch.randn_like(value[member])
+    return state_dict
+
+
+def legacy_mlp(state_dict, layers, out):
+    linear1, lnorm1, linear2, lnorm2, linear_out = layers
+    for linear, lnorm in ((linear1, lnorm1), (linear2, lnorm2)):
+        out = F.linear(out, state_dict[f"{linear}.weight"], state_dict[f"{linear}.bias"])
+        out = F.layer_norm(out, out.shape[-1:], state_dict[f"{lnorm}.weight"], state_dict[f"{lnorm}.bias"], 1e-6)
+        out = F.leaky_relu(out)
+    return F.linear(out, state_dict[f"{linear_out}.weight"], state_dict[f"{linear_out}.bias"])
+
+
+def test_critic_loads_the_twin_layers():
+    torch.manual_seed(0)
+    parameters = make_parameters()
+    critic = ddpg.Critic(parameters)
+    state_dict = legacy_state_dict(critic, CRITIC_LAYERS)
+    critic.load_state_dict(state_dict)
+
+    state, action = torch.randn(7, 5), torch.randn(7, 3)
+    expected = [legacy_mlp(state_dict, layers, torch.cat([state, action], -1)) for layers in CRITIC_LAYERS]
+    for q, expected_q in zip(critic(state, action), expected):
+        torch.testing.assert_close(q, expected_q)
+    torch.testing.assert_close(critic.Q1(state, action), expected[0])
+
+
+def test_policy_value_network_loads_the_twin_layers():
+    torch.manual_seed(0)
+    parameters = make_parameters()
+    pvn = ddpg.Policy_Value_Network(parameters)
+    twins = tuple(policy + critic for policy, critic in zip(PVN_POLICY_LAYERS, CRITIC_LAYERS))
+    state_dict = legacy_state_dict(pvn, twins)
+    pvn.load_state_dict(state_dict)
+
+    input = torch.randn(7, 8)
+    param = torch.randn(7, parameters.ls * parameters.action_dim + parameters.action_dim)
+    expected = []
+    for policy_layers, layers in zip(PVN_POLICY_LAYERS, CRITIC_LAYERS):
+        out_p = param.reshape(-1, parameters.ls + 1)
+        for i, layer in enumerate(policy_layers):
+            out_p = F.linear(out_p, state_dict[f"{layer}.weight"], state_dict[f"{layer}.bias"])
+            if i < 2:
+                out_p = F.leaky_relu(out_p)
+        out_p = out_p.reshape(-1, parameters.action_dim, parameters.pr).mean(1)
+        expected.append(legacy_mlp(state_dict, layers, torch.cat([input, out_p], 1)))
+    for q, expected_q in zip(pvn(input, param), expected):
+        torch.testing.assert_close(q, expected_q)
+    torch.testing.assert_close(pvn.Q1(input, param), expected[0])
@@ -0,0 +1,38 @@
+import torch
+
+from core import ddpg
+from parameters import Parameters
+
+
+def make_parameters():
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.action_dim = 3
+    parameters.ls = 300
+    return parameters
+
+
+def test_actor_parameters_stay_views_of_their_row():
+    parameters = make_parameters()
+    population = ddpg.PopulationTensor(parameters, 3)
+    others = population.get_rows([0, 2])
+    actor = ddpg.Actor(parameters, population=population, index=1)
+    num_weights = parameters.ls * parameters.action_dim
+
+    flat = torch.randn(num_weights + parameters.action_dim)
+    actor.load_flat(flat)
+    torch.testing.assert_close(population.params[1], flat)
+    torch.testing.assert_close(actor.w_out.weight.reshape(-1), flat[:num_weights])
+    torch.testing.assert_close(actor.w_out.bias, flat[num_weights:])
+
+    # Writes through the population, the module and the optimizer reach the same row
+    rows = torch.randn(1, len(flat))
+    population.set_rows([1], rows)
+    torch.testing.assert_close(actor.w_out.bias, rows[0, num_weights:])
+
+    optimizer = torch.optim.SGD(actor.parameters(), lr=1.0)
+    actor.w_out.bias.sum().backward()
+    optimizer.step()
+    torch.testing.assert_close(population.params[1, num_weights:], rows[0, num_weights:] - 1)
+    torch.testing.assert_close(population.get_rows([0, 2]), others)
+    assert actor.w_out.weight.data_ptr() == population.params[1].data_ptr()
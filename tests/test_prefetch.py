@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from core.prefetch import sample_batches
+from core.utils import PrioritizedReplayBuffer, ReplayBuffer
+from parameters import Parameters
+
+
+def make_parameters(prefetch=0, bulk_sampling=False, per=False):
+    parameters = Parameters(None, init=False)
+    parameters.prefetch = prefetch
+    parameters.bulk_sampling = bulk_sampling
+    parameters.per = per
+    return parameters
+
+
+def fill(replay_buffer, size):
+    """Adds size transitions whose state is their index"""
+    for i in range(size):
+        state = np.full(1, i, dtype=np.float32)
+        replay_buffer.add((state, state, np.zeros(1), np.zeros(1), np.zeros(1), np.zeros(1), 0))
+    return replay_buffer
+
+
+def make_prioritized_buffer(size):
+    replay_buffer = PrioritizedReplayBuffer(size)
+    replay_buffer.init_priorities(0.7, 0.5, 1000)
+    return fill(replay_buffer, size)
+
+
+@pytest.mark.parametrize("bulk_sampling", [False, True])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_batches_are_uniform_over_the_buffer(bulk_sampling, prefetch):
+    np.random.seed(0)
+    replay_buffer = fill(ReplayBuffer(10000), 10000)
+    batches = list(sample_batches(replay_buffer, 50, 100, "cpu", make_parameters(prefetch, bulk_sampling)))
+    assert len(batches) == 50
+    all_ind = []
+    for ind, batch in batches:
+        assert len(ind) == 100
+        np.testing.assert_array_equal(batch[0].numpy().reshape(-1), ind)
+        # Every batch is drawn from the whole buffer
+        assert ind.min() < 2500 and ind.max() >= 7500
+        all_ind.append(ind)
+    counts = np.bincount(np.concatenate(all_ind) // 1000, minlength=10)
+    assert counts.min() > 400 and counts.max() < 600
+
+
+def test_bulk_prioritized_batches_span_the_whole_buffer():
+    np.random.seed(0)
+    replay_buffer = make_prioritized_buffer(10000)
+    batches = sample_batches(replay_buffer, 100, 100, "cpu", make_parameters(bulk_sampling=True, per=True))
+    for ind, batch in batches:
+        # One index from each of the batch_size segments of uniform priorities
+        np.testing.assert_array_equal(np.sort(ind) // 100, np.arange(100))
+        np.testing.assert_array_equal(batch[0].numpy().reshape(-1), ind)
+
+
+def test_importance_weights_of_a_zero_priority_leaf():
+    replay_buffer = make_prioritized_buffer(8)
+    replay_buffer.tree.update_leaves([7], [0.0])
+    weights = replay_buffer.importance_weights([0, 7])
+    assert np.all(np.isfinite(weights))
+    assert weights[1] == 1.0
@@ -0,0 +1,24 @@
+import numpy as np
+
+from core.utils import ReplayBuffer
+
+
+def transition(policy_id):
+    return (np.zeros(3), np.zeros(3), np.zeros(2), np.zeros(1), np.zeros(1), np.zeros(2), policy_id)
+
+
+def test_overwrite_with_the_last_reference_of_the_same_policy():
+    replay_buffer = ReplayBuffer(3)
+    versions = replay_buffer.policy_versions
+    x, y = np.full(4, 1.0), np.full(4, 2.0)
+    replay_buffer.add(transition(versions.add(x)))
+    replay_buffer.add(transition(versions.add(y)))
+    replay_buffer.add(transition(versions.add(y)))
+    # Overwrites the slot holding the last reference of x with x again
+    x_id = versions.add(x)
+    replay_buffer.add(transition(x_id))
+    assert replay_buffer.policy_ids[0] == x_id
+
+    z_id = versions.add(np.full(4, 3.0))
+    assert z_id != x_id
+    np.testing.assert_array_equal(versions.get(replay_buffer.policy_ids[:1])[0], x)
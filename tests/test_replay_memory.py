@@ -0,0 +1,28 @@
+import numpy as np
+
+from core.replay_memory import IndexReplayMemory
+from core.utils import ReplayBuffer
+
+
+def transition():
+    return (np.zeros(3), np.zeros(3), np.zeros(2), np.zeros(1), np.zeros(1), np.zeros(2), 0)
+
+
+def test_len_counts_the_live_transitions():
+    rng = np.random.default_rng(0)
+    store = ReplayBuffer(50)
+    memory = IndexReplayMemory(20, "cpu", store)
+    other = IndexReplayMemory(30, "cpu", store)
+    for _ in range(500):
+        op = rng.integers(5)
+        if op == 0:
+            memory.add(store.add(transition()))
+        elif op == 1:
+            other.add(store.add(transition()))
+        elif op == 2:
+            memory.add_latest_from(other, int(rng.integers(1, 30)))
+        elif op == 3:
+            memory.shuffle()
+        elif rng.random() < 0.1:
+            memory.reset()
+        assert len(memory) == np.count_nonzero(store.is_live(memory.seqs[: memory.size]))
@@ -0,0 +1,48 @@
+import gymnasium as gym
+import numpy as np
+import torch
+
+from core import ddpg
+from core.rollout_workers import RolloutWorkerPool, run_episode
+from parameters import Parameters
+
+
+def make_parameters():
+    parameters = Parameters(None, init=False)
+    parameters.device = torch.device("cpu")
+    parameters.render = False
+    parameters.env_name = "Pendulum-v1"
+    parameters.seed = 1
+    parameters.state_dim = 3
+    parameters.action_dim = 1
+    parameters.ls = 300
+    parameters.use_ln = True
+    parameters.gamma = 0.99
+    parameters.time_steps = 50
+    parameters.pr = 64
+    parameters.OFF_TYPE = 1
+    return parameters
+
+
+def test_abandoned_call_does_not_leak_into_the_next_one():
+    parameters = make_parameters()
+    torch.manual_seed(0)
+    state_embedding = ddpg.shared_state_embedding(parameters)
+    population = ddpg.PopulationTensor(parameters, 6)
+    all_params = population.params.numpy()
+    pool = RolloutWorkerPool(parameters, 2)
+    try:
+        next(iter(pool.run(all_params[:3], state_embedding, store_transition=False)))
+        first_seed = pool.num_episodes
+        episodes = list(pool.run(all_params[3:], state_embedding, store_transition=False))
+    finally:
+        pool.close()
+
+    env = gym.make(parameters.env_name)
+    actor = ddpg.Actor(parameters)
+    for i, (row, episode) in enumerate(episodes):
+        assert row == i
+        pool.num_episodes = first_seed + i
+        actor.load_flat(torch.from_numpy(all_params[3 + i]))
+        expected = run_episode(env, actor, state_embedding, parameters, pool.next_seed(), store_transition=False)
+        assert episode["reward"] == expected["reward"]
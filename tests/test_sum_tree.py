@@ -0,0 +1,21 @@
+import numpy as np
+
+from core.mod_utils import SumTree
+
+
+def test_find_and_update_leaves_match_a_cumulative_sum():
+    rng = np.random.default_rng(0)
+    tree = SumTree(37)
+    priorities = np.zeros(37)
+    for _ in range(20):
+        # Repeated indices keep their last priority
+        indices = rng.integers(0, 37, size=10)
+        values = rng.uniform(0, 2, size=10)
+        tree.update_leaves(indices, values)
+        for index, value in zip(indices, values):
+            priorities[index] = value
+
+        np.testing.assert_allclose(tree.total(), priorities.sum())
+        cumsum = np.cumsum(priorities)
+        prefix_sums = rng.uniform(0, cumsum[-1], size=100)
+        np.testing.assert_array_equal(tree.find(prefix_sums), np.searchsorted(cumsum, prefix_sums))